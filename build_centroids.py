@@ -1,13 +1,14 @@
 from typing import List, Dict, Tuple
 
-from dataset.pickle import load_dataset_in_batches, load_graph_distances
+from dataset.pickle import load_graph_store, load_graph_distances
 
 from graph.essential import Graph
+from graph.store import GraphStore
 from graph.distances import weighted_distance, euclidean_distance, manhattan_distance, cosine_score, best_of_the_best_distance
 
 from indexing.algorithms import MeanShift
 
-graphs: List[Graph] = load_dataset_in_batches("pickles/graphs")
+graphs: GraphStore = load_graph_store("pickles/graphs")
 
 # cosine_cache: Dict[Tuple[str, str], float] = load_graph_distances("pickles/distance_cache", "cosine.p")
 # euclidean_cache: Dict[Tuple[str, str], float] = load_graph_distances("pickles/distance_cache", "euclidean.p")
@@ -1,14 +1,16 @@
 from typing import List
 
-from dataset.pickle import load_dataset_in_batches, load_centroids
+from dataset.pickle import load_graph_store, load_centroids
 
 from graph.essential import Graph
+from graph.store import GraphStore
 from graph.distances import weighted_distance, cosine_score, euclidean_distance, manhattan_distance, best_of_the_best_distance
 
 from indexing.indexes import HyperGraph
+from indexing.cache import DiskDistanceCache
 
 
-graphs: List[Graph] = load_dataset_in_batches("pickles/graphs")
+graphs: GraphStore = load_graph_store("pickles/graphs")
 
 # cosine_centroids: List[Graph] = load_centroids("pickles/centroids", "cosine_6.p")
 # euclidean_centroids: List[Graph] = load_centroids("pickles/centroids", "euclidean_6.p")
@@ -17,7 +19,9 @@ graphs: List[Graph] = load_dataset_in_batches("pickles/graphs")
 best_centroids: List[Graph] = load_centroids("pickles/centroids", "best_distance_1.5.p")
 
 def build_hyper_graphs(centroids, distance_fn, save_clusters_path, filename, threshold):
-    hypergraph = HyperGraph(graphs, distance_fn, threshold, centroids)
+    # distances computed by earlier runs, whatever their threshold, are read back instead of recomputed
+    cache = DiskDistanceCache.open("pickles/distance_cache", graphs, distance_fn)
+    hypergraph = HyperGraph(graphs, distance_fn, threshold, centroids, distance_cache=cache)
 
     print("------------------------- start -------------------------")
     hypergraph.fit()
@@ -0,0 +1,35 @@
+import os
+import time
+
+from dataset.pickle import load_graph_store
+
+from graph.store import GraphStore
+from graph.distances import weighted_distance, cosine_score, manhattan_distance, euclidean_distance, best_of_the_best_distance, cosine_v_distance, l2__distance
+
+from indexing.indexes import convert_clusters
+
+graphs: GraphStore = load_graph_store("pickles/graphs")
+
+save_path = "pickles/hyper_graphs"
+
+hyper_graphs = [
+    ("weighted_6.p", weighted_distance, 6),
+    ("weighted_7.p", weighted_distance, 7),
+    ("cosine_6.p", cosine_score, 6),
+    ("cosine_7.p", cosine_score, 7),
+    ("manhattan_6.p", manhattan_distance, 6),
+    ("manhattan_7.p", manhattan_distance, 7),
+    ("euclidean_6.p", euclidean_distance, 6),
+    ("euclidean_7.p", euclidean_distance, 7),
+    ("l2_6.p", l2__distance, 1.5),
+    ("cosine_v_0_3.p", cosine_v_distance, 0.055),
+    ("best_distance_1.5.p", best_of_the_best_distance, 1.5)
+]
+
+for filename, distance_fn, threshold in hyper_graphs:
+    start = time.time()
+    converted = convert_clusters(save_path, filename, graphs, distance_fn, threshold)
+
+    old_size = os.path.getsize(save_path + "/" + filename)
+    new_size = os.path.getsize(save_path + "/" + converted)
+    print(f"{filename} -> {converted}: {old_size / 2 ** 20:.1f} MB -> {new_size / 2 ** 20:.2f} MB in {time.time() - start:.2f} s")
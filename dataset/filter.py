@@ -1,37 +1,22 @@
 import subprocess
-import time
 import os
 
-from graph.embeddings.full_body_3D import get_graph_from_full_body_image
-from graph.embeddings.full_body_3D import get_pose_model
+from typing import Optional
+
+from dataset.ingest import extract_graphs
 
 
 def filter_dataset(
         dataset_dir: str,
         new_dataset_dir: str,
         threshold: float = 0.8,
-        delay: float = 0.5
+        workers: Optional[int] = None
 ) -> None:
-    pose_model = get_pose_model()
-    paths = os.listdir(dataset_dir)
-    i = 0
-
-    for image_path in paths:
-        i += 1
-
-        try:
-            total_path = dataset_dir + "/" + image_path
-            _ = get_graph_from_full_body_image(path=total_path, pose_model=pose_model, threshold=threshold)
-
-            new_total_path = new_dataset_dir + "/" + image_path
-            subprocess.run(["cp", total_path, new_total_path])
-
-        except AttributeError:
-            continue
+    paths = [dataset_dir + "/" + image_path for image_path in sorted(os.listdir(dataset_dir))]
 
-        except AssertionError:
+    for total_path, graph, _ in extract_graphs(paths, threshold=threshold, workers=workers):
+        if graph is None:
             continue
 
-        finally:
-            if i % 10 == 0:
-                time.sleep(delay)
+        new_total_path = new_dataset_dir + "/" + os.path.basename(total_path)
+        subprocess.run(["cp", total_path, new_total_path])
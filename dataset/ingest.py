@@ -0,0 +1,102 @@
+import os
+import queue
+import threading
+import time
+
+from multiprocess import Process, Queue
+from typing import Iterator, List, Optional, Tuple
+
+from graph.essential import Graph
+from graph.embeddings.full_body_3D import get_graph_from_full_body_image, get_pose_model
+
+# how often the throughput is reported, in images
+REPORT_EVERY: int = 100
+
+# how long to wait for a result before checking that the workers are still alive, in seconds
+POLL_SECONDS: float = 5.0
+
+
+def _extract_worker(
+        tasks: Queue,
+        results: Queue,
+        threshold: float
+) -> None:
+    # every worker owns its model, MediaPipe graphs are neither picklable nor thread safe
+    pose_model = get_pose_model()
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        index, path = task
+
+        try:
+            results.put((index, get_graph_from_full_body_image(path=path, pose_model=pose_model, threshold=threshold), None))
+        except Exception as e:
+            # AttributeError: no person found, AssertionError: low visibility, anything else: unreadable image
+            results.put((index, None, str(e)))
+
+
+def extract_graphs(
+        paths: List[str],
+        threshold: float = 0.8,
+        workers: Optional[int] = None,
+        queue_size: Optional[int] = None
+) -> Iterator[Tuple[str, Optional[Graph], Optional[str]]]:
+    # yields (path, graph or None, error or None) in the order of `paths`
+    workers = workers or os.cpu_count() or 1
+    queue_size = queue_size or 4 * workers
+
+    # bounded both ways, so neither the paths nor the extracted graphs pile up in memory
+    tasks = Queue(maxsize=queue_size)
+    results = Queue(maxsize=queue_size)
+
+    processes = [Process(target=_extract_worker, args=(tasks, results, threshold), daemon=True) for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    def feed() -> None:
+        for task in enumerate(paths):
+            tasks.put(task)
+        for _ in processes:
+            tasks.put(None)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    start = time.time()
+    pending = {}
+    done: int = 0
+
+    try:
+        while done < len(paths):
+            try:
+                index, graph, error = results.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                # a worker killed by the OS (out of memory, a crash in native code) never reports back
+                crashed = [process for process in processes if process.exitcode not in (None, 0)]
+                if crashed or not any(process.is_alive() for process in processes):
+                    codes = ", ".join(str(process.exitcode) for process in crashed)
+                    reason = f"exit codes {codes}" if crashed else "all workers exited"
+                    raise RuntimeError(f"Extraction stopped after {done}/{len(paths)} images: {reason}")
+                continue
+
+            pending[index] = (graph, error)
+
+            # workers finish out of order, results are handed on in input order
+            while done in pending:
+                graph, error = pending.pop(done)
+                yield paths[done], graph, error
+                done += 1
+
+                if done % REPORT_EVERY == 0 or done == len(paths):
+                    print(f"{done}/{len(paths)} images, {done / (time.time() - start):.1f} images/s with {workers} workers")
+    finally:
+        # also reached when the caller stops early: the workers are not waited for then
+        if done < len(paths):
+            for process in processes:
+                process.terminate()
+
+        for process in processes:
+            process.join()
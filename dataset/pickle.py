@@ -1,11 +1,16 @@
 import pickle
 import time
 import os
+import re
 
-from typing import List, Dict, Callable, Tuple
+from typing import List, Dict, Callable, Tuple, Optional
 
-from graph.essential import Graph
-from graph.embeddings.full_body_3D import get_graph_from_full_body_image, get_pose_model
+from multiprocess import pool
+import numpy as np
+
+from graph.essential import Graph, Edges
+from graph.store import GraphStore, STORE_FILENAME, N_VERTEXES, VERTEX_SIZE
+from dataset.ingest import extract_graphs
 
 
 def dump_graphs(
@@ -20,39 +25,26 @@ def dump_dataset_in_batches(
         pickle_dir: str,
         graphs_per_batch: int,
         threshold: float = 0.8,
-        delay: float = 0.05
+        workers: Optional[int] = None
 ) -> None:
-    pose_model = get_pose_model()
-
     graphs: List[Graph] = []
-    paths: List[str] = os.listdir(dataset_dir)
+    paths: List[str] = [dataset_dir + "/" + image_path for image_path in sorted(os.listdir(dataset_dir))]
 
     current_batch_id: int = 1
 
-    for image_path in paths:
-
-        try:
-            total_path: str = dataset_dir + "/" + image_path
-
-            graph: Graph = get_graph_from_full_body_image(path=total_path, pose_model=pose_model, threshold=threshold)
-            graphs.append(graph)
-
-        except AttributeError as e:
-            print(e)
-            continue
-
-        except AssertionError as e:
-            print(e)
+    # the poses are extracted by worker processes, shards are only written from here
+    for _, graph, error in extract_graphs(paths, threshold=threshold, workers=workers):
+        if graph is None:
+            print(error)
             continue
 
-        finally:
-            time.sleep(delay)
+        graphs.append(graph)
 
-            # dump the graphs collection just when a determined limit was exceeded
-            if len(graphs) > graphs_per_batch:
-                dump_graphs(graphs=graphs, filename=f"{pickle_dir}/graphs_{current_batch_id}.p")
-                graphs = []
-                current_batch_id += 1
+        # dump the graphs collection just when a determined limit was exceeded
+        if len(graphs) > graphs_per_batch:
+            dump_graphs(graphs=graphs, filename=f"{pickle_dir}/graphs_{current_batch_id}.p")
+            graphs = []
+            current_batch_id += 1
 
     # dump the remaining data
     dump_graphs(graphs, f"{pickle_dir}/graphs_{current_batch_id}.p")
@@ -93,16 +85,86 @@ def load_graphs(
         return graphs
 
 
-def load_dataset_in_batches(
+def shard_files(
         pickle_dir: str
+) -> List[str]:
+    # graphs_2.p before graphs_10.p, so graph ids do not depend on the directory listing order
+    def key(filename: str):
+        return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", filename)]
+
+    return sorted([path for path in os.listdir(pickle_dir) if path.endswith(".p")], key=key)
+
+
+def _load_shard(
+        filename: str
+) -> Tuple[np.ndarray, List[str], Edges, float]:
+    # packed inside the worker, so only arrays and paths travel back to the parent
+    start = time.time()
+    store = GraphStore.from_graphs(load_graphs(filename))
+    return store.get_vertexes(), store.get_paths(), store.get_edges(), time.time() - start
+
+
+def load_shards(
+        pickle_dir: str,
+        workers: Optional[int] = None
+) -> GraphStore:
+    filenames = [pickle_dir + "/" + path for path in shard_files(pickle_dir)]
+    workers = min(workers or os.cpu_count() or 1, max(len(filenames), 1))
+    start = time.time()
+
+    if workers > 1:
+        with pool.Pool(processes=workers) as executor:
+            shards = executor.map(_load_shard, filenames)
+    else:
+        shards = [_load_shard(filename) for filename in filenames]
+
+    # every shard is copied once into a block sized for all of them, in shard order
+    vertexes = np.empty((sum(len(paths) for _, paths, _, _ in shards), N_VERTEXES, VERTEX_SIZE), dtype=np.float32)
+    paths: List[str] = []
+    edges: Edges = ()
+
+    for filename, (shard_vertexes, shard_paths, shard_edges, elapsed) in zip(filenames, shards):
+        vertexes[len(paths):len(paths) + len(shard_paths)] = shard_vertexes
+        paths.extend(shard_paths)
+        edges = edges or shard_edges
+        print(f"{os.path.basename(filename)}: {len(shard_paths)} graphs in {elapsed:.2f} s")
+
+    print(f"{len(paths)} graphs from {len(filenames)} shards in {time.time() - start:.2f} s with {workers} workers")
+    return GraphStore(vertexes, paths, edges)
+
+
+def load_dataset_in_batches(
+        pickle_dir: str,
+        mmap_mode: Optional[str] = None,
+        workers: Optional[int] = None
 ) -> List[Graph]:
-    graphs: List[Graph] = []
-    paths = os.listdir(pickle_dir)
+    # graphs are views into the store rows, so the position in the dataset is the graph id
+    return load_graph_store(pickle_dir, mmap_mode, workers).get_graphs()
+
+
+def load_graph_store(
+        pickle_dir: str,
+        mmap_mode: Optional[str] = None,
+        workers: Optional[int] = None
+) -> GraphStore:
+    if mmap_mode is not None:
+        return GraphStore.load(packed_store(pickle_dir, workers), mmap_mode)
+
+    return load_shards(pickle_dir, workers)
+
+
+def packed_store(
+        pickle_dir: str,
+        workers: Optional[int] = None
+) -> str:
+    # the shards packed into one store file, rebuilt whenever a shard is newer than it
+    filename: str = pickle_dir + "/" + STORE_FILENAME
+    shards = [pickle_dir + "/" + path for path in shard_files(pickle_dir)]
 
-    for path in paths:
-        graphs += load_graphs(pickle_dir + "/" + path)
+    if not os.path.exists(filename) or any(os.path.getmtime(shard) > os.path.getmtime(filename) for shard in shards):
+        load_shards(pickle_dir, workers).save(filename)
 
-    return graphs
+    return filename
 
 
 def load_graph_distances(
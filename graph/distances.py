@@ -1,42 +1,38 @@
-from math import pow, sqrt, log2
-from numpy import array, dot
-from numpy.linalg import norm
-from graph.essential import Graph
+from math import log2
+from typing import Callable, Dict, Optional, Union
+from numpy import asarray, float64, ndarray, zeros, errstate
+from numpy import sqrt as np_sqrt, abs as np_abs, log2 as np_log2
+from graph.essential import Graph, Edges, POSE_EDGES
+from graph.features import bone_vectors, unit_vectors, visibility_weighted, matrix_norms
+from graph.store import PoseBlock, N_VERTEXES
+
+KEY_POINTS = {"hips": 0.4, "ankles": 0.4, "knees": 0.4,
+              "shoulders": 0.4, "elbows": 0.4, "wrists": 0.4,
+              "ears": 0.2, "nose": 0.0, "eyes": 0.0, "mouth": 0.0, "pinky": 0.0,
+              "index": 0.0, "thumb": 0.1, "heel": 0.1, "foot_index": 0.0}
+KEY_POINT_TO_LANDMARKS = {
+    "hips": [23, 24], "ankles": [27, 28],
+    "knees": [25, 26], "shoulders": [11, 12],
+    "elbows": [13, 14], "wrists": [15, 16],
+    "ears": [7, 8], "nose": [0],
+    "eyes": [1, 2, 3, 4, 5, 6],
+    "mouth": [9, 10], "pinky": [17, 18], "index": [19, 20],
+    "thumb": [21, 22], "heel": [29, 30], "foot_index": [31, 32]
+}
 
 
 def cosine_score(
         graph1: Graph,
         graph2: Graph
 ) -> float:
-    edges = graph1.get_edges()
-    distance = 0
-
-    for u, v in edges:
-        vertex_u1, vertex_v1 = graph1.get_vertex(u), graph1.get_vertex(v)
-        vertex_u2, vertex_v2 = graph2.get_vertex(u), graph2.get_vertex(v)
-
-        v1 = array([(vertex_v1[0] - vertex_u1[0]), (vertex_v1[1] - vertex_u1[1]), (vertex_v1[2] - vertex_u1[2])])
-        v2 = array([(vertex_v2[0] - vertex_u2[0]), (vertex_v2[1] - vertex_u2[1]), (vertex_v2[2] - vertex_u2[2])])
-
-        distance += (1 - dot(v1, v2) / (norm(v1) * norm(v2)))
-
-    return distance
+    return float(cosine_score_batch(graph1, graph2))
 
 
 def euclidean_distance(
         graph1: Graph,
         graph2: Graph
 ) -> float:
-    n_vertexes = graph1.vertexes_count
-
-    distance = 0
-    for v in range(n_vertexes):
-        x1, y1, z1, _ = graph1.get_vertex(v)
-        x2, y2, z2, _ = graph2.get_vertex(v)
-
-        distance += sqrt(pow(x1 - x2, 2) + pow(y1 - y2, 2) + pow(z1 - z2, 2))
-
-    return distance
+    return float(euclidean_distance_batch(graph1, graph2))
 
 
 def weighted_distance(
@@ -58,72 +54,199 @@ def manhattan_distance(
         graph1: Graph,
         graph2: Graph
 ) -> float:
-    n_vertexes = graph1.vertexes_count
-
-    distance = 0
-    for v in range(n_vertexes):
-        x1, y1, z1, _ = graph1.get_vertex(v)
-        x2, y2, z2, _ = graph2.get_vertex(v)
-
-        distance += abs(x1 - x2) + abs(y1 - y2) + abs(z1 - z2)
-
-    return distance
+    return float(manhattan_distance_batch(graph1, graph2))
 
 
 def l2_distance(
         graph1: Graph,
         graph2: Graph
 ) -> float:
-    array1 = array(graph1.get_vertexes())
-    array2 = array(graph2.get_vertexes())
-
-    return norm(array1 - array2)
+    return float(l2_distance_batch(graph1, graph2))
 
 
 def l2__distance(
         graph1: Graph,
         graph2: Graph
 ) -> float:
-    arr1 = array(list(map(lambda x: array(x[:3]) * x[3], graph1.get_vertexes())))
-    arr2 = array(list(map(lambda x: array(x[:3]) * x[3], graph2.get_vertexes())))
-    return norm(arr1 - arr2)
+    return float(l2__distance_batch(graph1, graph2))
 
 
 def cosine_v_distance(
         graph1: Graph,
         graph2: Graph
 ) -> float:
-    arr1 = array(list(map(lambda x: array(x[:3]) * x[3], graph1.get_vertexes())))
-    arr2 = array(list(map(lambda x: array(x[:3]) * x[3], graph2.get_vertexes())))
-    return 1 - dot(arr1.reshape(-1), arr2.reshape(-1)) / (norm(arr1) * norm(arr2))
+    return float(cosine_v_distance_batch(graph1, graph2))
 
 
 def best_of_the_best_distance(
         graph1: Graph,
         graph2: Graph
 ) -> float:
-    key_points = {"hips": 0.4, "ankles": 0.4, "knees": 0.4,
-                 "shoulders": 0.4, "elbows": 0.4, "wrists": 0.4,
-                 "ears": 0.2, "nose": 0.0, "eyes": 0.0, "mouth": 0.0, "pinky": 0.0,
-                 "index": 0.0, "thumb": 0.1, "heel": 0.1, "foot_index": 0.0}
-    key_point_to_landmarks = {
-        "hips": [23, 24], "ankles": [27, 28],
-        "knees": [25, 26], "shoulders": [11, 12],
-        "elbows": [13, 14], "wrists": [15, 16],
-        "ears": [7, 8], "nose": [0],
-        "eyes": [1, 2, 3, 4, 5, 6],
-        "mouth": [9, 10], "pinky": [17, 18], "index": [19, 20],
-        "thumb": [21, 22], "heel": [29, 30], "foot_index": [31, 32]
-    }
-
-    array1 = array(graph1.get_vertexes())
-    array2 = array(graph2.get_vertexes())
-
-    dist = 0
-    for key in key_points:
-        for landmark in key_point_to_landmarks[key]:
-            dist += norm(array1[landmark] - array2[landmark])*key_points[key]
-
-    return log2(1+dist)
+    return float(best_of_the_best_distance_batch(graph1, graph2))
+
+
+# batch kernels: `query` and `vertexes` are Graphs, PoseBlocks or (..., 33, 4) arrays whose leading
+# axes broadcast, so one pose against an (N, 33, 4) block returns N distances; Graphs and PoseBlocks
+# bring their cached features, which is what the scalar distances and the store-wide passes rely on
+
+Pose = Union[Graph, PoseBlock, ndarray]
+
+
+def _as_vertexes(
+        pose: Pose
+) -> ndarray:
+    if isinstance(pose, (Graph, PoseBlock)):
+        return pose.get_vertex_array()
+    return asarray(pose, dtype=float64)
+
+
+def _edges(
+        query: Pose,
+        vertexes: Pose
+) -> Edges:
+    # bones only line up when both sides share a topology, a plain array takes the other side's
+    known = [pose.get_edges() for pose in (query, vertexes) if isinstance(pose, (Graph, PoseBlock))]
+
+    if len(known) == 2 and known[0] is not known[1]:
+        raise ValueError("Can't compare bones of poses with different topologies")
+
+    return known[0] if known else POSE_EDGES
+
+
+def _unit_bones(
+        pose: Pose,
+        edges
+) -> ndarray:
+    if isinstance(pose, (Graph, PoseBlock)):
+        return pose.get_unit_bones()
+
+    with errstate(invalid="ignore", divide="ignore"):
+        return unit_vectors(bone_vectors(_as_vertexes(pose), edges))
+
+
+def _weighted(
+        pose: Pose
+) -> ndarray:
+    if isinstance(pose, (Graph, PoseBlock)):
+        return pose.get_weighted_vertexes()
+    return visibility_weighted(_as_vertexes(pose))
+
+
+def _weighted_norm(
+        pose: Pose
+):
+    if isinstance(pose, (Graph, PoseBlock)):
+        return pose.get_weighted_norm()
+    return matrix_norms(_weighted(pose))
+
+
+def _landmark_weights(
+) -> ndarray:
+    weights = zeros(N_VERTEXES, dtype=float64)
+    for key in KEY_POINTS:
+        for landmark in KEY_POINT_TO_LANDMARKS[key]:
+            weights[landmark] = KEY_POINTS[key]
+    return weights
+
+
+LANDMARK_WEIGHTS: ndarray = _landmark_weights()
+
+
+def cosine_score_batch(
+        query: Pose,
+        vertexes: ndarray
+) -> ndarray:
+    edges = _edges(query, vertexes)
+    cosines = (_unit_bones(query, edges) * _unit_bones(vertexes, edges)).sum(axis=-1)
+    return (1 - cosines).sum(axis=-1)
+
+
+def euclidean_distance_batch(
+        query: Pose,
+        vertexes: ndarray
+) -> ndarray:
+    diff = _as_vertexes(query)[..., :3] - _as_vertexes(vertexes)[..., :3]
+    return np_sqrt((diff * diff).sum(axis=-1)).sum(axis=-1)
+
+
+def weighted_distance_batch(
+        query: Pose,
+        vertexes: ndarray,
+        k: float = 0.5
+) -> ndarray:
+    return cosine_score_batch(query, vertexes) + (k * euclidean_distance_batch(query, vertexes))
+
+
+def log_weighted_distance_batch(
+        query: Pose,
+        vertexes: ndarray
+) -> ndarray:
+    return cosine_score_batch(query, vertexes) * np_log2(euclidean_distance_batch(query, vertexes) + 1)
+
+
+def manhattan_distance_batch(
+        query: Pose,
+        vertexes: ndarray
+) -> ndarray:
+    diff = _as_vertexes(query)[..., :3] - _as_vertexes(vertexes)[..., :3]
+    return np_abs(diff).sum(axis=-1).sum(axis=-1)
+
+
+def l2_distance_batch(
+        query: Pose,
+        vertexes: ndarray
+) -> ndarray:
+    return matrix_norms(_as_vertexes(query) - _as_vertexes(vertexes))
+
+
+def l2__distance_batch(
+        query: Pose,
+        vertexes: ndarray
+) -> ndarray:
+    return matrix_norms(_weighted(query) - _weighted(vertexes))
+
+
+def cosine_v_distance_batch(
+        query: Pose,
+        vertexes: ndarray
+) -> ndarray:
+    dots = (_weighted(query) * _weighted(vertexes)).sum(axis=(-2, -1))
+    return 1 - dots / (_weighted_norm(query) * _weighted_norm(vertexes))
+
+
+def best_of_the_best_distance_batch(
+        query: Pose,
+        vertexes: ndarray
+) -> ndarray:
+    diff = _as_vertexes(query) - _as_vertexes(vertexes)
+    dist = (np_sqrt((diff * diff).sum(axis=-1)) * LANDMARK_WEIGHTS).sum(axis=-1)
+    return np_log2(1 + dist)
+
+
+_BATCH_DISTANCES: Dict[Callable[[Graph, Graph], float], Callable[[Pose, ndarray], ndarray]] = {
+    cosine_score: cosine_score_batch,
+    euclidean_distance: euclidean_distance_batch,
+    weighted_distance: weighted_distance_batch,
+    log_weighted_distance: log_weighted_distance_batch,
+    manhattan_distance: manhattan_distance_batch,
+    l2_distance: l2_distance_batch,
+    l2__distance: l2__distance_batch,
+    cosine_v_distance: cosine_v_distance_batch,
+    best_of_the_best_distance: best_of_the_best_distance_batch
+}
+
+
+# distances that satisfy the triangle inequality, the ones exact pruned searches can rely on
+METRIC_DISTANCES = {euclidean_distance, manhattan_distance, l2_distance, l2__distance, best_of_the_best_distance}
+
+
+def is_metric(
+        distance: Callable[[Graph, Graph], float]
+) -> bool:
+    return distance in METRIC_DISTANCES
 
 
+def get_batch_distance(
+        distance: Callable[[Graph, Graph], float]
+) -> Optional[Callable[[Pose, ndarray], ndarray]]:
+    return _BATCH_DISTANCES.get(distance)
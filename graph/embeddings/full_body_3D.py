@@ -1,11 +1,17 @@
-import mediapipe as mp
-import cv2
+from typing import TYPE_CHECKING
 
-from graph.essential import Graph
+from graph.essential import Graph, POSE_EDGES
+
+# mediapipe and cv2 are only imported where a pose is actually extracted, so loading datasets
+# and indexes (and forking workers) doesn't pay for them
+if TYPE_CHECKING:
+    import mediapipe as mp
 
 
 def get_pose_model(
-) -> mp.solutions.pose.Pose:
+) -> "mp.solutions.pose.Pose":
+    import mediapipe as mp
+
     return mp.solutions.pose.Pose(
         static_image_mode=True,
         model_complexity=2
@@ -14,9 +20,11 @@ def get_pose_model(
 
 def get_graph_from_full_body_image(
         path: str,
-        pose_model: mp.solutions.pose.Pose,
+        pose_model: "mp.solutions.pose.Pose",
         threshold: float
 ) -> Graph:
+    import cv2
+
     image = cv2.imread(path)
     image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
@@ -39,5 +47,4 @@ def get_graph_from_full_body_image(
     if avg < threshold:
         raise AssertionError("The image may contain an invalid person")
 
-    edges = list(mp.solutions.pose.POSE_CONNECTIONS)
-    return Graph(path, nodes, edges)
+    return Graph(path, nodes, POSE_EDGES)
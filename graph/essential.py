@@ -1,20 +1,69 @@
-from typing import List, Tuple, Union
+from typing import List, Tuple, Union, Dict, Callable, Optional, Sequence
+from numpy import ndarray, array, float32, float64, errstate, vstack
+
+from graph.features import bone_vectors, vector_norms, unit_vectors, visibility_weighted, matrix_norms
+
+Edges = Tuple[Tuple[int, int], ...]
+
+# mp.solutions.pose.POSE_CONNECTIONS, in the order the pickled dataset stores them
+POSE_EDGES: Edges = (
+    (15, 21), (16, 20), (18, 20), (3, 7), (14, 16), (23, 25), (28, 30), (11, 23), (27, 31),
+    (6, 8), (15, 17), (24, 26), (16, 22), (4, 5), (5, 6), (29, 31), (12, 24), (23, 24),
+    (0, 1), (9, 10), (1, 2), (0, 4), (11, 13), (30, 32), (28, 32), (15, 19), (16, 18),
+    (25, 27), (26, 28), (12, 14), (17, 19), (2, 3), (11, 12), (27, 29), (13, 15)
+)
+
+# every distinct topology is kept once, graphs only hold a reference to it
+_TOPOLOGIES: Dict[Edges, Edges] = {POSE_EDGES: POSE_EDGES}
+
+
+def intern_edges(
+        edges: Sequence[Tuple[int, int]]
+) -> Edges:
+    key = tuple((int(u), int(v)) for u, v in edges)
+    return _TOPOLOGIES.setdefault(key, key)
 
 
 class Graph:
+    __slots__ = ("_path", "_vertexes", "_edges", "_id", "_features")
+
     _path: str
-    _vertexes: List[Tuple[float, float, float, float]]
-    _edges: List[Tuple[int, int]]
+    _vertexes: ndarray
+    _edges: Edges
+    _id: int
+
+    # derived arrays computed once per graph, dropped whenever vertexes or edges change
+    _features: Optional[Dict[str, ndarray]]
 
     def __init__(
             self,
             path: str,
-            vertexes: List[Tuple[float, float, float, float]],
-            edges: List[Tuple[int, int]]
+            vertexes: Union[List[Tuple[float, float, float, float]], ndarray],
+            edges: Sequence[Tuple[int, int]],
+            graph_id: int = -1
     ):
-        self._vertexes = vertexes.copy()
-        self._edges = edges.copy()
+        # numpy rows are kept as views so a graph can live inside a GraphStore block, lists are stored
+        # in the store's float32 and only widened by get_vertex_array
+        self._vertexes = vertexes if isinstance(vertexes, ndarray) else array(vertexes, dtype=float32)
+        self._edges = intern_edges(edges)
         self._path = path
+        self._id = graph_id
+        self._features = None
+
+    def __getstate__(
+            self
+    ) -> Dict:
+        return {"_path": self._path, "_vertexes": self._vertexes, "_edges": self._edges, "_id": self._id}
+
+    def __setstate__(
+            self,
+            state
+    ) -> None:
+        # pickles written before __slots__ carry a plain __dict__ with list vertexes and edges
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **(state[1] or {})}
+
+        self.__init__(state["_path"], state["_vertexes"], state["_edges"], state.get("_id", -1))
 
     def __repr__(
             self
@@ -25,46 +74,104 @@ class Graph:
             self,
             vertex: Tuple[float, float, float, float]
     ):
-        self._vertexes.append(vertex)
+        # always a new array, so a graph backed by a store row detaches from it
+        self._vertexes = vstack([self._vertexes.reshape(-1, len(vertex)), array([vertex], dtype=float32)])
+        self._features = None
 
     def add_edge(
             self,
             edges: Tuple[int, int]
     ):
-        self._edges.append(edges)
+        self._edges = intern_edges(self._edges + (edges,))
+        self._features = None
 
     def set_vertexes(
             self,
-            vertexes: List[Tuple[float, float, float, float]]
+            vertexes: Union[List[Tuple[float, float, float, float]], ndarray]
     ):
-        self._vertexes = vertexes
+        self._vertexes = vertexes if isinstance(vertexes, ndarray) else array(vertexes, dtype=float32)
+        self._features = None
 
     def set_edges(
             self,
-            edges: List[Tuple[int, int]]
+            edges: Sequence[Tuple[int, int]]
     ):
-        self._edges = edges
+        self._edges = intern_edges(edges)
+        self._features = None
+
+    def _feature(
+            self,
+            name: str,
+            compute: Callable[[], ndarray]
+    ) -> ndarray:
+        if self._features is None:
+            self._features = {}
+
+        if name not in self._features:
+            self._features[name] = compute()
+
+        return self._features[name]
+
+    def get_vertex_array(
+            self
+    ) -> ndarray:
+        return self._feature("vertexes", lambda: self._vertexes.astype(float64, copy=False))
+
+    def get_bones(
+            self
+    ) -> ndarray:
+        return self._feature("bones", lambda: bone_vectors(self.get_vertex_array(), self._edges))
+
+    def get_bone_norms(
+            self
+    ) -> ndarray:
+        return self._feature("bone_norms", lambda: vector_norms(self.get_bones()))
+
+    def get_unit_bones(
+            self
+    ) -> ndarray:
+        def compute() -> ndarray:
+            # zero length bones give nan, exactly like the cosine they feed
+            with errstate(invalid="ignore", divide="ignore"):
+                return unit_vectors(self.get_bones())
+
+        return self._feature("unit_bones", compute)
+
+    def get_weighted_vertexes(
+            self
+    ) -> ndarray:
+        return self._feature("weighted", lambda: visibility_weighted(self.get_vertex_array()))
+
+    def get_weighted_norm(
+            self
+    ) -> float:
+        return float(self._feature("weighted_norm", lambda: matrix_norms(self.get_weighted_vertexes())))
 
     def get_path(
             self
     ) -> str:
         return self._path
 
+    def get_id(
+            self
+    ) -> int:
+        return self._id
+
     def get_vertexes(
             self
-    ) -> List[Tuple[float, float, float, float]]:
+    ) -> ndarray:
         return self._vertexes
 
     def get_edges(
             self
-    ) -> List[Tuple[int, int]]:
+    ) -> Edges:
         return self._edges
 
     def get_vertex(
             self,
             index: int
     ) -> Tuple[float, float, float, float]:
-        return self._vertexes[index]
+        return tuple(self._vertexes[index].tolist())
 
     def get_edge(
             self,
@@ -0,0 +1,37 @@
+from typing import Sequence, Tuple
+from numpy import ndarray, sqrt
+
+
+def bone_vectors(
+        vertexes: ndarray,
+        edges: Sequence[Tuple[int, int]]
+) -> ndarray:
+    u = [edge[0] for edge in edges]
+    v = [edge[1] for edge in edges]
+    # take keeps the poses in C order, advanced indexing would move the bone axis outermost
+    # and make the later reductions run over strided memory in a shape dependent order
+    return vertexes.take(v, axis=-2)[..., :3] - vertexes.take(u, axis=-2)[..., :3]
+
+
+def vector_norms(
+        vectors: ndarray
+) -> ndarray:
+    return sqrt((vectors * vectors).sum(axis=-1))
+
+
+def unit_vectors(
+        vectors: ndarray
+) -> ndarray:
+    return vectors / vector_norms(vectors)[..., None]
+
+
+def visibility_weighted(
+        vertexes: ndarray
+) -> ndarray:
+    return vertexes[..., :3] * vertexes[..., 3:]
+
+
+def matrix_norms(
+        matrices: ndarray
+) -> ndarray:
+    return sqrt((matrices * matrices).sum(axis=(-2, -1)))
@@ -0,0 +1,263 @@
+import json
+import os
+from math import isqrt
+from typing import Callable, Optional, Tuple, Union
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from graph.essential import Graph, POSE_EDGES
+from graph.store import GraphStore, PoseBlock, N_VERTEXES, VERTEX_SIZE, pose_block
+from graph.distances import get_batch_distance
+
+# rough float64 footprint of one pair inside a batch kernel (operands plus temporaries)
+PAIR_BYTES: int = N_VERTEXES * VERTEX_SIZE * 8 * 3
+MEMORY_BUDGET: int = 256 * 1024 * 1024
+
+Key = Tuple[Union[int, str], Union[int, str]]
+
+
+def condensed_size(
+        n: int
+) -> int:
+    return n * (n - 1) // 2
+
+
+def condensed_index(
+        n: int,
+        i,
+        j
+):
+    # position of the pair (i, j), i < j, inside the upper triangle stored row by row
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+
+def cross_distances(
+        distance: Callable[[Graph, Graph], float],
+        queries: np.ndarray,
+        vertexes: np.ndarray,
+        memory_budget: int = MEMORY_BUDGET
+) -> np.ndarray:
+    batch_distance = get_batch_distance(distance)
+    result = np.empty((len(queries), len(vertexes)), dtype=np.float64)
+
+    if batch_distance is None:
+        graphs = [Graph("", v, POSE_EDGES) for v in vertexes]
+        for i, query in enumerate(queries):
+            query_graph = Graph("", query, POSE_EDGES)
+            result[i] = [distance(graph, query_graph) for graph in graphs]
+        return result
+
+    # the derived arrays of a column chunk take about a quarter of the budget and are reused by every
+    # row chunk, the kernel temporaries take the rest; nothing is expanded beyond one chunk
+    columns: int = max(1, memory_budget // (4 * PAIR_BYTES))
+
+    for c0 in range(0, len(vertexes), columns):
+        block: PoseBlock = pose_block(vertexes[c0:c0 + columns], POSE_EDGES)
+        rows: int = max(1, memory_budget // (PAIR_BYTES * len(block)))
+
+        for r0 in range(0, len(queries), rows):
+            result[r0:r0 + rows, c0:c0 + columns] = batch_distance(pose_block(queries[r0:r0 + rows, None], POSE_EDGES), block)
+
+    return result
+
+
+class PairwiseDistances:
+    _matrix: np.ndarray
+    _n: int
+    _rows_done: int
+    _fingerprint: Optional[str]
+    _store: Optional[GraphStore]
+
+    def __init__(
+            self,
+            matrix: np.ndarray,
+            n: int,
+            rows_done: int,
+            fingerprint: Optional[str] = None,
+            store: Optional[GraphStore] = None
+    ) -> None:
+        if matrix.shape != (condensed_size(n),):
+            raise ValueError(f"A condensed matrix of {n} graphs needs {condensed_size(n)} entries, got {matrix.shape}")
+
+        self._matrix = matrix
+        self._n = n
+        self._rows_done = rows_done
+        self._fingerprint = fingerprint
+        self._store = store
+
+    @classmethod
+    def open(
+            cls,
+            filename: str,
+            store: Optional[GraphStore] = None,
+            mode: str = "r"
+    ) -> "PairwiseDistances":
+        with open(filename + ".json", "r") as file:
+            progress = json.load(file)
+
+        matrix = np.load(filename, mmap_mode=mode)
+        return cls(matrix, progress["n"], progress["rows_done"], progress.get("fingerprint"), store)
+
+    def __len__(
+            self
+    ) -> int:
+        return self._n
+
+    def matches(
+            self,
+            store: GraphStore
+    ) -> bool:
+        return len(store) == self._n and store.get_fingerprint() == self._fingerprint
+
+    def _resolve(
+            self,
+            key: Key
+    ) -> Tuple[int, int]:
+        i, j = key
+        if (isinstance(i, str) or isinstance(j, str)) and self._store is None:
+            raise ValueError("Looking pairs up by path needs the GraphStore the distances were computed for")
+
+        if isinstance(i, str):
+            i = self._store.get_id(i)
+        if isinstance(j, str):
+            j = self._store.get_id(j)
+        return (i, j) if i <= j else (j, i)
+
+    def __contains__(
+            self,
+            key: Key
+    ) -> bool:
+        i, j = self._resolve(key)
+        return 0 <= i and j < self._n and (i == j or i < self._rows_done)
+
+    def __getitem__(
+            self,
+            key: Key
+    ) -> float:
+        i, j = self._resolve(key)
+        if i == j:
+            return 0.0
+        return float(self._matrix[condensed_index(self._n, i, j)])
+
+    def __setitem__(
+            self,
+            key: Key,
+            value: float
+    ) -> None:
+        if not self._matrix.flags.writeable:
+            raise ValueError("The pairwise distances were opened read-only, open them with mode \"r+\" to write")
+
+        i, j = self._resolve(key)
+        if i != j:
+            self._matrix[condensed_index(self._n, i, j)] = value
+
+    def is_complete(
+            self
+    ) -> bool:
+        return self._rows_done >= self._n - 1
+
+    def get_condensed(
+            self
+    ) -> np.ndarray:
+        return self._matrix
+
+    def row(
+            self,
+            i: int
+    ) -> np.ndarray:
+        return self.submatrix(np.array([i]), np.arange(self._n))[0]
+
+    def submatrix(
+            self,
+            rows: np.ndarray,
+            cols: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = rows if cols is None else np.asarray(cols, dtype=np.int64)
+
+        lo = np.minimum(rows[:, None], cols[None, :])
+        hi = np.maximum(rows[:, None], cols[None, :])
+        off_diagonal = lo != hi
+
+        block = np.zeros(lo.shape, dtype=np.float64)
+        block[off_diagonal] = self._matrix[condensed_index(self._n, lo[off_diagonal], hi[off_diagonal])]
+        return block
+
+    def row_sums(
+            self,
+            rows: np.ndarray,
+            cols: Optional[np.ndarray] = None,
+            memory_budget: int = MEMORY_BUDGET
+    ) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = rows if cols is None else np.asarray(cols, dtype=np.int64)
+
+        # submatrix holds about five 8 byte values per pair: bounds, mask, indexes and the block
+        chunk: int = max(1, memory_budget // (5 * 8 * max(len(cols), 1)))
+        sums: np.ndarray = np.empty(len(rows), dtype=np.float64)
+
+        for r0 in range(0, len(rows), chunk):
+            sums[r0:r0 + chunk] = self.submatrix(rows[r0:r0 + chunk], cols).sum(axis=1)
+
+        return sums
+
+
+def compute_pairwise_distances(
+        store: GraphStore,
+        distance: Callable[[Graph, Graph], float],
+        filename: str,
+        memory_budget: int = MEMORY_BUDGET
+) -> PairwiseDistances:
+    batch_distance = get_batch_distance(distance)
+    if batch_distance is None:
+        raise ValueError(f"{distance.__name__} has no batch kernel")
+
+    n: int = len(store)
+    metric: str = distance.__name__
+    fingerprint: str = store.get_fingerprint()
+    vertexes: np.ndarray = store.get_vertexes()
+
+    # square tiles sized so a single kernel call stays within the memory budget
+    tile: int = max(1, isqrt(max(1, memory_budget // PAIR_BYTES)))
+
+    rows_done: int = 0
+    progress_filename: str = filename + ".json"
+
+    if os.path.exists(filename) and os.path.exists(progress_filename):
+        with open(progress_filename, "r") as file:
+            progress = json.load(file)
+
+        # a matrix of another store with the same number of graphs is started over, not resumed
+        if progress["n"] == n and progress["metric"] == metric and progress.get("fingerprint") == fingerprint:
+            rows_done = progress["rows_done"]
+
+    if rows_done > 0:
+        matrix = np.load(filename, mmap_mode="r+")
+    else:
+        matrix = open_memmap(filename, mode="w+", dtype=np.float32, shape=(condensed_size(n),))
+
+    for r0 in range(rows_done, n - 1, tile):
+        r1 = min(r0 + tile, n - 1)
+
+        for c0 in range(r0 + 1, n, tile):
+            c1 = min(c0 + tile, n)
+            block = batch_distance(vertexes[r0:r1, None], vertexes[None, c0:c1])
+
+            for i in range(r0, min(r1, c1 - 1)):
+                start = max(c0, i + 1)
+                offset = condensed_index(n, i, start)
+                matrix[offset:offset + c1 - start] = block[i - r0, start - c0:]
+
+        # the row block is only marked as done once it reached the disk
+        matrix.flush()
+        with open(progress_filename, "w") as file:
+            json.dump({"n": n, "metric": metric, "fingerprint": fingerprint, "rows_done": r1}, file)
+
+        print(f"pairwise distances: {r1}/{n - 1} rows")
+
+    if n < 2:
+        with open(progress_filename, "w") as file:
+            json.dump({"n": n, "metric": metric, "fingerprint": fingerprint, "rows_done": 0}, file)
+
+    return PairwiseDistances(np.load(filename, mmap_mode="r"), n, max(n - 1, 0), fingerprint, store)
@@ -0,0 +1,336 @@
+from typing import Callable, List, Tuple, Dict, Iterator, Union, Sequence, Optional
+from multiprocessing.shared_memory import SharedMemory
+import hashlib
+import os
+import zipfile
+import numpy as np
+from numpy.lib import format as npy_format
+
+from graph.essential import Graph, Edges, POSE_EDGES, intern_edges
+from graph.features import bone_vectors, unit_vectors, visibility_weighted, matrix_norms
+
+N_VERTEXES: int = 33
+VERTEX_SIZE: int = 4
+
+# packed store saved next to the pickled shards and the version 2 indexes
+STORE_FILENAME: str = "graphs.npz"
+
+
+def stack_vertexes(
+        graphs: List[Graph],
+        dtype=np.float32
+) -> np.ndarray:
+    vertexes = np.empty((len(graphs), N_VERTEXES, VERTEX_SIZE), dtype=dtype)
+
+    for i, graph in enumerate(graphs):
+        vertexes[i] = graph.get_vertexes()
+
+    return vertexes
+
+
+def share_vertexes(
+        vertexes: np.ndarray
+) -> SharedMemory:
+    shared = SharedMemory(create=True, size=max(vertexes.nbytes, 1))
+    np.ndarray(vertexes.shape, dtype=vertexes.dtype, buffer=shared.buf)[:] = vertexes
+    return shared
+
+
+def attach_vertexes(
+        name: str,
+        shape: Tuple[int, ...],
+        dtype: str
+) -> Tuple[SharedMemory, np.ndarray]:
+    # the caller must keep the SharedMemory handle alive as long as the array is in use
+    shared = SharedMemory(name=name)
+    return shared, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shared.buf)
+
+
+def load_arrays(
+        filename: str,
+        mmap_mode: Optional[str] = None
+) -> Dict[str, np.ndarray]:
+    if mmap_mode is None:
+        with np.load(filename, allow_pickle=False) as data:
+            return {name: data[name] for name in data.files}
+
+    # np.savez stores its members uncompressed, so each array can be mapped straight out of the
+    # zip: skip the member's local header, then the .npy header, and what is left is the raw data
+    arrays: Dict[str, np.ndarray] = {}
+
+    with zipfile.ZipFile(filename) as archive, open(filename, "rb") as file:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{info.filename} in {filename} is compressed and can't be memory-mapped")
+
+            file.seek(info.header_offset + 26)
+            name_length, extra_length = np.frombuffer(file.read(4), dtype="<u2")
+            file.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+
+            version = npy_format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = npy_format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = npy_format.read_array_header_2_0(file)
+
+            name = info.filename[:-len(".npy")] if info.filename.endswith(".npy") else info.filename
+
+            if dtype.hasobject:
+                raise ValueError(f"{name} in {filename} holds Python objects")
+
+            # scalars and empty arrays are cheaper to read than to map
+            if len(shape) == 0 or np.prod(shape) == 0:
+                arrays[name] = np.fromfile(file, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+                continue
+
+            arrays[name] = np.memmap(
+                filename, dtype=dtype, mode=mmap_mode, offset=file.tell(), shape=shape,
+                order="F" if fortran_order else "C"
+            )
+
+    return arrays
+
+
+class PoseBlock:
+    # a chunk of poses whose derived arrays are computed on first use and then reused by every kernel
+    # call on the chunk; indexing slices the arrays computed so far, so blocks broadcast like vertexes do
+    __slots__ = ("_vertexes", "_edges", "_features")
+
+    _vertexes: np.ndarray
+    _edges: Edges
+    _features: Dict[str, np.ndarray]
+
+    def __init__(
+            self,
+            vertexes: np.ndarray,
+            edges: Edges,
+            features: Optional[Dict[str, np.ndarray]] = None
+    ) -> None:
+        self._vertexes = vertexes
+        self._edges = edges
+        self._features = features or {}
+
+    @classmethod
+    def empty(
+            cls,
+            capacity: int,
+            edges: Edges
+    ) -> "PoseBlock":
+        # every derived array preallocated, so poses can be written in one at a time
+        return cls(np.empty((capacity, N_VERTEXES, VERTEX_SIZE), dtype=np.float64), edges, {
+            "unit_bones": np.empty((capacity, len(edges), 3), dtype=np.float64),
+            "weighted": np.empty((capacity, N_VERTEXES, 3), dtype=np.float64),
+            "weighted_norm": np.empty(capacity, dtype=np.float64)
+        })
+
+    def __len__(
+            self
+    ) -> int:
+        return len(self._vertexes)
+
+    def __getitem__(
+            self,
+            key
+    ) -> "PoseBlock":
+        return PoseBlock(self._vertexes[key], self._edges, {name: array[key] for name, array in self._features.items()})
+
+    def __setitem__(
+            self,
+            key,
+            block: "PoseBlock"
+    ) -> None:
+        # only for blocks made by empty, which hold every derived array
+        self._vertexes[key] = block.get_vertex_array()
+        self._features["unit_bones"][key] = block.get_unit_bones()
+        self._features["weighted"][key] = block.get_weighted_vertexes()
+        self._features["weighted_norm"][key] = block.get_weighted_norm()
+
+    def _feature(
+            self,
+            name: str,
+            compute: Callable[[], np.ndarray]
+    ) -> np.ndarray:
+        if name not in self._features:
+            self._features[name] = compute()
+        return self._features[name]
+
+    def get_vertex_array(
+            self
+    ) -> np.ndarray:
+        return self._vertexes
+
+    def get_unit_bones(
+            self
+    ) -> np.ndarray:
+        def compute() -> np.ndarray:
+            # zero length bones give nan, exactly like the cosine they feed
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return unit_vectors(bone_vectors(self._vertexes, self._edges))
+
+        return self._feature("unit_bones", compute)
+
+    def get_weighted_vertexes(
+            self
+    ) -> np.ndarray:
+        return self._feature("weighted", lambda: visibility_weighted(self._vertexes))
+
+    def get_weighted_norm(
+            self
+    ) -> np.ndarray:
+        return self._feature("weighted_norm", lambda: matrix_norms(self.get_weighted_vertexes()))
+
+    def get_edges(
+            self
+    ) -> Edges:
+        return self._edges
+
+
+def pose_block(
+        vertexes: np.ndarray,
+        edges: Edges
+) -> PoseBlock:
+    return PoseBlock(np.asarray(vertexes, dtype=np.float64), edges)
+
+
+class GraphStore:
+    _vertexes: np.ndarray
+    _paths: List[str]
+    _ids: Dict[str, int]
+    _edges: Edges
+
+    def __init__(
+            self,
+            vertexes: np.ndarray,
+            paths: List[str],
+            edges: Sequence[Tuple[int, int]]
+    ) -> None:
+        if vertexes.ndim != 3 or vertexes.shape[1:] != (N_VERTEXES, VERTEX_SIZE):
+            raise ValueError(f"Expected a (N, {N_VERTEXES}, {VERTEX_SIZE}) block, got {vertexes.shape}")
+
+        if len(paths) != vertexes.shape[0]:
+            raise ValueError(f"Got {len(paths)} paths for {vertexes.shape[0]} poses")
+
+        # the batch paths hand plain vertex arrays around and build bones from POSE_EDGES, so a
+        # store of any other topology would silently compare misaligned bones
+        edges = intern_edges(edges)
+        if len(vertexes) > 0 and edges is not POSE_EDGES:
+            raise ValueError("A GraphStore only holds poses with the POSE_EDGES topology")
+
+        self._vertexes = vertexes
+        self._paths = list(paths)
+        self._ids = {path: i for i, path in enumerate(self._paths)}
+        self._edges = edges
+
+    @classmethod
+    def from_graphs(
+            cls,
+            graphs: List[Graph]
+    ) -> "GraphStore":
+        vertexes = stack_vertexes(graphs)
+        edges = graphs[0].get_edges() if len(graphs) > 0 else ()
+
+        if any(graph.get_edges() is not edges for graph in graphs):
+            raise ValueError("All the graphs of a GraphStore must share one topology")
+
+        return cls(vertexes, [graph.get_path() for graph in graphs], edges)
+
+    @classmethod
+    def concatenate(
+            cls,
+            stores: List["GraphStore"]
+    ) -> "GraphStore":
+        stores = [store for store in stores if len(store) > 0]
+
+        if len(stores) == 0:
+            return cls(np.empty((0, N_VERTEXES, VERTEX_SIZE), dtype=np.float32), [], ())
+
+        vertexes = np.concatenate([store.get_vertexes() for store in stores])
+        paths = [path for store in stores for path in store.get_paths()]
+        return cls(vertexes, paths, stores[0].get_edges())
+
+    @classmethod
+    def load(
+            cls,
+            filename: str,
+            mmap_mode: Optional[str] = None
+    ) -> "GraphStore":
+        # with a mmap mode the vertexes stay in the page cache, shared by every process reading the file
+        data = load_arrays(filename, mmap_mode)
+        return cls(data["vertexes"], data["paths"].tolist(), [tuple(edge) for edge in data["edges"].tolist()])
+
+    def save(
+            self,
+            filename: str
+    ) -> None:
+        # plain arrays only, so the file loads without unpickling anything; written aside and
+        # renamed so processes that have the old file mapped keep reading a complete one
+        with open(filename + ".tmp", "wb") as file:
+            np.savez(
+                file,
+                vertexes=self._vertexes,
+                paths=np.array(self._paths, dtype=np.str_),
+                edges=np.array(self._edges, dtype=np.int64).reshape(-1, 2)
+            )
+        os.replace(filename + ".tmp", filename)
+
+    def __len__(
+            self
+    ) -> int:
+        return self._vertexes.shape[0]
+
+    def __iter__(
+            self
+    ) -> Iterator[Graph]:
+        for i in range(len(self)):
+            yield self.get_graph(i)
+
+    def get_vertexes(
+            self
+    ) -> np.ndarray:
+        return self._vertexes
+
+    def get_paths(
+            self
+    ) -> List[str]:
+        return self._paths
+
+    def get_path(
+            self,
+            graph_id: int
+    ) -> str:
+        return self._paths[graph_id]
+
+    def get_id(
+            self,
+            path: str
+    ) -> int:
+        return self._ids.get(path, -1)
+
+    def get_edges(
+            self
+    ) -> Edges:
+        return self._edges
+
+    def get_fingerprint(
+            self
+    ) -> str:
+        # ids are only meaningful for the exact same poses in the exact same order
+        digest = hashlib.sha1()
+        for path in self._paths:
+            digest.update(path.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get_graph(
+            self,
+            graph_id: int
+    ) -> Graph:
+        return Graph(self._paths[graph_id], self._vertexes[graph_id], self._edges, graph_id)
+
+    def get_graphs(
+            self,
+            graph_ids: Union[List[int], np.ndarray, None] = None
+    ) -> List[Graph]:
+        if graph_ids is None:
+            graph_ids = range(len(self))
+        return [self.get_graph(int(i)) for i in graph_ids]
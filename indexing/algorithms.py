@@ -1,92 +1,280 @@
-from multiprocess import pool
-
-from typing import Callable, List, Dict, Tuple
-from graph.essential import Graph, Cluster
+import numpy as np
+
+from typing import Callable, List, Dict, Tuple, Union, Optional
+from graph.essential import Graph, Cluster, POSE_EDGES
+from graph.store import GraphStore, PoseBlock, pose_block
+from graph.distances import get_batch_distance
+from graph.pairwise import PairwiseDistances, PAIR_BYTES, MEMORY_BUDGET
+from indexing.workers import WorkerPool, worker_vertexes, worker_distance
+from indexing.cache import DistanceCache, DiskDistanceCache, cached_cross_distances
 from dataset.pickle import load_centroids, dump_centroids
 
 
+# clusters smaller than this are cheaper to score in-process than to ship to the workers
+POOL_MIN_SIZE: int = 1000
+
+
+def _worker_distance_sums(
+        args: Tuple[np.ndarray, np.ndarray, Optional[DiskDistanceCache]]
+) -> np.ndarray:
+    # only one sum per row goes back to the parent, the rows themselves go to the disk cache if any
+    rows, cols, cache = args
+    block = cached_cross_distances(worker_distance(), worker_vertexes(), rows, cols, cache)
+    block[rows[:, None] == cols[None, :]] = 0
+    return block.sum(axis=1)
+
+
+def leader_clustering(
+        vertexes: np.ndarray,
+        order: np.ndarray,
+        threshold: float,
+        batch_distance: Callable[[np.ndarray, np.ndarray], np.ndarray]
+) -> Tuple[np.ndarray, np.ndarray]:
+    # returns the leader ids and, for every graph in `order`, the position of its leader
+    labels: np.ndarray = np.empty(len(order), dtype=np.int64)
+    leader_ids: List[int] = []
+
+    # leaders grow by doubling so every pose is compared against one contiguous block, their derived
+    # arrays are computed once when they join instead of on every comparison
+    leaders: PoseBlock = PoseBlock.empty(16, POSE_EDGES)
+
+    for position, graph_id in enumerate(order):
+        count: int = len(leader_ids)
+
+        if count > 0:
+            within = np.flatnonzero(batch_distance(vertexes[graph_id], leaders[:count]) <= threshold)
+
+            if len(within) > 0:
+                labels[position] = within[0]
+                continue
+
+        if count == len(leaders):
+            grown = PoseBlock.empty(2 * count, POSE_EDGES)
+            grown[:count] = leaders
+            leaders = grown
+
+        leaders[count:count + 1] = pose_block(vertexes[graph_id:graph_id + 1], POSE_EDGES)
+        leader_ids.append(int(graph_id))
+        labels[position] = count
+
+    return np.array(leader_ids, dtype=np.int64), labels
+
+
+def _worker_leader_clustering(
+        args: Tuple[np.ndarray, float]
+) -> Tuple[np.ndarray, np.ndarray]:
+    order, threshold = args
+    return leader_clustering(worker_vertexes(), order, threshold, get_batch_distance(worker_distance()))
+
+
 class MeanShift:
     _threshold: float = 0
-    _centroids: List[Graph] = []
-    _graphs: List[Graph] = []
+    _centroids: List[Graph]
+    _graph_ids: np.ndarray
+    _store: GraphStore
     _distance: Callable[[Graph, Graph], float] = None
-    _distances_cache: Dict[Tuple[str, str], float] = {}
+    _distance_function: Callable[[Graph, Graph], float] = None
+
+    # owned by the instance, so several clusterers in one process never share or grow a cache together
+    _distances_cache: Union[DistanceCache, DiskDistanceCache, PairwiseDistances]
+    _cache_hits: int
+    _cache_misses: int
+
+    # worker pool kept alive for the duration of a fit
+    _pool: Optional[WorkerPool] = None
+
+    # clusters above this size get an approximate medoid
+    _medoid_sample_size: Optional[int] = None
+    _rng: np.random.Generator
+
+    # cluster position of every graph after a leader fit
+    _labels: Optional[np.ndarray] = None
 
     def __init__(
             self,
-            graphs: List[Graph],
+            graphs: Union[List[Graph], GraphStore],
             threshold: float,
             distance_function: Callable[[Graph, Graph], float],
-            distance_cache: Dict[Tuple[str, str], float] = None
+            distance_cache: Union[
+                Dict[Tuple[Union[int, str], Union[int, str]], float], DistanceCache, DiskDistanceCache, PairwiseDistances
+            ] = None,
+            medoid_sample_size: Optional[int] = None,
+            seed: int = 0,
+            cache_budget: int = MEMORY_BUDGET
     ) -> None:
 
         def optimized_distance(g1: Graph, g2: Graph) -> float:
-            if self._distance is not None and (g1.get_path(), g2.get_path()) in self._distances_cache:
-                return self._distances_cache[(g1.get_path(), g2.get_path())]
+            key = (g1.get_id(), g2.get_id())
+
+            if key in self._distances_cache:
+                self._cache_hits += 1
+                return self._distances_cache[key]
 
+            self._cache_misses += 1
             dist = distance_function(g1, g2)
 
-            self._distances_cache[(g2.get_path(), g1.get_path())] = dist
-            self._distances_cache[(g1.get_path(), g2.get_path())] = dist
+            self._distances_cache[key] = dist
             return dist
 
+        # graphs are always taken from the store, so their ids are its row indices; views are only
+        # made by the fits that need Graph objects
+        self._store = graphs if isinstance(graphs, GraphStore) else GraphStore.from_graphs(graphs)
+
         self._threshold = threshold
-        self._graphs = graphs
+        self._centroids = []
+        self._graph_ids = np.arange(len(self._store))
         self._distance = optimized_distance
+        self._distance_function = distance_function
+        self._medoid_sample_size = medoid_sample_size
+        self._rng = np.random.default_rng(seed)
+
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+        if isinstance(distance_cache, (DiskDistanceCache, PairwiseDistances)) and not distance_cache.matches(self._store):
+            raise ValueError("The distance cache was opened for a different set of graphs")
 
-        if distance_cache is not None:
+        # missing pairs of a partial matrix would be written where compute_pairwise_distances resumes
+        if isinstance(distance_cache, PairwiseDistances) and not distance_cache.is_complete():
+            raise ValueError("The pairwise distances are incomplete, finish compute_pairwise_distances first")
+
+        if isinstance(distance_cache, dict):
+            self._distances_cache = DistanceCache.from_dict(self._id_keyed(distance_cache), cache_budget)
+        elif distance_cache is not None:
             self._distances_cache = distance_cache
+        else:
+            self._distances_cache = DistanceCache(cache_budget)
 
-    def calculate_distance(
+    def _id_keyed(
             self,
-            args: Tuple[int, List[Graph]]
-    ) -> Tuple[int, float]:
-        i, s = args
-        distances_sum = 0
-        n = len(s)
+            cache: Dict[Tuple[Union[int, str], Union[int, str]], float]
+    ) -> Dict[Tuple[int, int], float]:
+        # caches dumped by dump_graph_distances are keyed by paths
+        def graph_id(key: Union[int, str]) -> int:
+            return self._store.get_id(key) if isinstance(key, str) else key
 
-        for j in range(n):
-            if i == j:
-                continue
-            distances_sum += self._distance(s[i], s[j])
+        return {(graph_id(i), graph_id(j)): dist for (i, j), dist in cache.items()}
+
+    def _start_workers(
+            self,
+            workers: Optional[int] = None
+    ) -> None:
+        self._pool = WorkerPool(self._store.get_vertexes(), self._distance_function, workers)
+
+    def _stop_workers(
+            self
+    ) -> None:
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def _ids(
+            self,
+            s: List[Graph]
+    ) -> np.ndarray:
+        return np.array([graph.get_id() for graph in s], dtype=np.int64)
+
+    def _cross_distances(
+            self,
+            rows: np.ndarray,
+            cols: np.ndarray
+    ) -> np.ndarray:
+        # an on-disk cache is read and filled block by block, every other cache is pair by pair
+        cache = self._distances_cache if isinstance(self._distances_cache, DiskDistanceCache) else None
+        return cached_cross_distances(self._distance_function, self._store.get_vertexes(), rows, cols, cache)
+
+    def _pooled_median_graph(
+            self,
+            s: List[Graph]
+    ) -> int:
+        ids: np.ndarray = self._ids(s)
+        cache = self._distances_cache if isinstance(self._distances_cache, DiskDistanceCache) else None
+
+        # a few tasks per worker for balance, each small enough to stay within the memory budget
+        chunk: int = max(1, min(-(-len(ids) // (4 * self._pool.workers)), MEMORY_BUDGET // (PAIR_BYTES * len(ids))))
+
+        tasks = [(ids[i:i + chunk], ids, cache) for i in range(0, len(ids), chunk)]
+        sums: np.ndarray = np.concatenate(self._pool.map(_worker_distance_sums, tasks))
 
-        return i, distances_sum
+        # rows the workers wrote are on disk now, but not yet known to this process
+        if cache is not None:
+            cache.reload()
+
+        return int(sums.argmin())
+
+    def _distance_sums(
+            self,
+            rows: np.ndarray,
+            cols: np.ndarray
+    ) -> np.ndarray:
+        sums: np.ndarray = np.empty(len(rows), dtype=np.float64)
+        chunk: int = max(1, MEMORY_BUDGET // (PAIR_BYTES * max(len(cols), 1)))
+
+        for r0 in range(0, len(rows), chunk):
+            block = self._cross_distances(rows[r0:r0 + chunk], cols)
+            # a graph never counts its distance to itself
+            block[rows[r0:r0 + chunk, None] == cols[None, :]] = 0
+            sums[r0:r0 + chunk] = block.sum(axis=1)
+
+        return sums
+
+    def _sampled_median_graph(
+            self,
+            ids: np.ndarray
+    ) -> int:
+        # Every candidate is scored against r random references instead of all n graphs.
+        # With distances bounded by the cluster diameter D, Hoeffding and a union bound give
+        # |estimated - true mean distance| <= D * sqrt(ln(2n / delta) / (2r)) for all candidates
+        # at once with probability 1 - delta, so the chosen graph's mean distance is within
+        # twice that bound of the exact medoid's.
+        references = ids[self._rng.choice(len(ids), size=self._medoid_sample_size, replace=False)]
+        return int(self._distance_sums(ids, references).argmin())
 
     def median_graph(
             self,
             s: List[Graph]
     ) -> int:
         n: int = len(s)
+        ids: np.ndarray = self._ids(s)
+
+        if self._medoid_sample_size is not None and n > self._medoid_sample_size:
+            return self._sampled_median_graph(ids)
 
-        with pool.Pool() as executor:
-            futures = [(i, s) for i in range(n)]
-            results = executor.map(self.calculate_distance, futures)
+        if isinstance(self._distances_cache, PairwiseDistances) and self._distances_cache.is_complete():
+            return int(self._distances_cache.row_sums(ids).argmin())
 
-        median_graph_index, _ = min(results, key=lambda x: x[1])
+        if self._pool is not None and n >= POOL_MIN_SIZE:
+            return self._pooled_median_graph(s)
 
-        return median_graph_index
+        return int(self._distance_sums(ids, ids).argmin())
 
     def farthest(
             self,
             s: List[Graph],
             seed: int
     ) -> int:
-        n: int = len(s)
-        farthest_graph_index: int = -1
-        distance: float = -1
+        ids: np.ndarray = self._ids(s)
+        return int(self._cross_distances(ids[seed:seed + 1], ids)[0].argmax())
 
-        for i in range(n):
-            if current_distance := self._distance(s[seed], s[i]) > distance:
-                farthest_graph_index = i
-                distance = current_distance
+    def fit(
+            self,
+            max_iter: int = 100,
+            workers: Optional[int] = None
+    ) -> None:
+        # clusters only shrink, so a set below the cutoff never needs the workers
+        if len(self._graph_ids) >= POOL_MIN_SIZE:
+            self._start_workers(workers)
 
-        return farthest_graph_index
+        try:
+            self._fit(max_iter)
+        finally:
+            self._stop_workers()
 
-    def fit(
+    def _fit(
             self,
-            max_iter: int = 100
+            max_iter: int
     ) -> None:
-        s: List[Graph] = self._graphs.copy()
+        s: List[Graph] = self._store.get_graphs(self._graph_ids)
         self._centroids.clear()
 
         while len(s) > 0:
@@ -103,7 +291,7 @@ class MeanShift:
 
             while True:
                 for graph in s:
-                    if graph.get_path() == prototype_graph.get_path():
+                    if graph.get_id() == prototype_graph.get_id():
                         continue
 
                     is_cluster_member = True
@@ -123,18 +311,28 @@ class MeanShift:
 
                 iterations += 1
 
-                if new_prototype_graph.get_path() == prototype_graph.get_path() or iterations >= max_iter:
+                if new_prototype_graph.get_id() == prototype_graph.get_id() or iterations >= max_iter:
                     self._centroids.append(prototype_graph)
                     print(f"new centroid... {cluster.size()} elements on {iterations} iterations")
-                    s = [g for g in s if g.get_path() not in {u.get_path() for u in cluster_graphs}]
+                    clustered = {graph.get_id() for graph in cluster_graphs}
+                    s = [g for g in s if g.get_id() not in clustered]
                     break
 
                 prototype_graph = new_prototype_graph
                 cluster = Cluster()
                 cluster.set_centroid(prototype_graph)
 
-    def fit_leader_algorithm(self) -> None:
-        s: List[Graph] = self._graphs.copy()
+    def fit_leader_algorithm(
+            self,
+            batched: bool = True
+    ) -> None:
+        batch_distance = get_batch_distance(self._distance_function)
+
+        if batched and batch_distance is not None:
+            self._fit_batched_leader_algorithm(batch_distance)
+            return
+
+        s: List[Graph] = self._store.get_graphs(self._graph_ids)
         self._centroids.clear()
 
         clusters: List[Cluster] = []
@@ -153,6 +351,77 @@ class MeanShift:
 
         self._centroids = [cluster.get_centroid() for cluster in clusters]
 
+    def _fit_batched_leader_algorithm(
+            self,
+            batch_distance: Callable[[np.ndarray, np.ndarray], np.ndarray]
+    ) -> None:
+        n: int = len(self._graph_ids)
+        ids: np.ndarray = self._graph_ids
+
+        # same visiting order as the list based version: the first graph, then the rest backwards
+        order: np.ndarray = np.concatenate([np.arange(min(n, 1)), np.arange(n - 1, 0, -1)])
+
+        leader_ids, labels = leader_clustering(self._store.get_vertexes(), ids[order], self._threshold, batch_distance)
+
+        self._labels = np.empty(n, dtype=np.int64)
+        self._labels[order] = labels
+        self._centroids = self._store.get_graphs(leader_ids)
+        print(f"{len(self._centroids)} centroids")
+
+    def fit_parallel_leader_algorithm(
+            self,
+            workers: Optional[int] = None
+    ) -> None:
+        batch_distance = get_batch_distance(self._distance_function)
+
+        if batch_distance is None:
+            self.fit_leader_algorithm()
+            return
+
+        n: int = len(self._graph_ids)
+        ids: np.ndarray = self._graph_ids
+        order: np.ndarray = np.concatenate([np.arange(min(n, 1)), np.arange(n - 1, 0, -1)])
+
+        self._start_workers(workers)
+
+        try:
+            shards = np.array_split(order, self._pool.workers)
+            results = self._pool.map(_worker_leader_clustering, [(ids[shard], self._threshold) for shard in shards])
+        finally:
+            self._stop_workers()
+
+        # merge phase: the shard leaders go through the leader algorithm once more, in shard order,
+        # so a graph ends up at most twice the threshold away from its final centroid
+        shard_leader_ids = np.concatenate([leader_ids for leader_ids, _ in results])
+        leader_ids, merged_labels = leader_clustering(
+            self._store.get_vertexes(), shard_leader_ids, self._threshold, batch_distance
+        )
+
+        self._labels = np.empty(n, dtype=np.int64)
+        offset: int = 0
+
+        for shard, (shard_leaders, shard_labels) in zip(shards, results):
+            self._labels[shard] = merged_labels[offset + shard_labels]
+            offset += len(shard_leaders)
+
+        self._centroids = self._store.get_graphs(leader_ids)
+        print(f"{len(self._centroids)} centroids from {len(shard_leader_ids)} shard leaders")
+
+    def get_cache_hits(
+            self
+    ) -> int:
+        return self._cache_hits
+
+    def get_cache_misses(
+            self
+    ) -> int:
+        return self._cache_misses
+
+    def get_labels(
+            self
+    ) -> Optional[np.ndarray]:
+        return self._labels
+
     def get_centroids(
             self
     ) -> List[Graph]:
@@ -0,0 +1,278 @@
+import json
+import os
+import shutil
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Set, Tuple
+
+import numpy as np
+
+from graph.essential import Graph
+from graph.store import GraphStore
+from graph.pairwise import MEMORY_BUDGET, cross_distances
+
+# measured footprint of one entry: ordered dict node, key tuple, two ints and a float
+ENTRY_BYTES: int = 250
+
+
+class DistanceCache:
+    _distances: "OrderedDict[Tuple[int, int], float]"
+    _max_entries: int
+    _evictions: int
+
+    def __init__(
+            self,
+            memory_budget: int = MEMORY_BUDGET
+    ) -> None:
+        self._distances = OrderedDict()
+        self._max_entries = max(1, memory_budget // ENTRY_BYTES)
+        self._evictions = 0
+
+    @classmethod
+    def from_dict(
+            cls,
+            distances: Dict[Tuple[int, int], float],
+            memory_budget: int = MEMORY_BUDGET
+    ) -> "DistanceCache":
+        cache = cls(memory_budget)
+        for key, distance in distances.items():
+            cache[key] = distance
+        return cache
+
+    @staticmethod
+    def _key(
+            key: Tuple[int, int]
+    ) -> Tuple[int, int]:
+        # distances are symmetric, each pair is stored once under (smaller id, larger id)
+        i, j = key
+        return (i, j) if i <= j else (j, i)
+
+    def __len__(
+            self
+    ) -> int:
+        return len(self._distances)
+
+    def __contains__(
+            self,
+            key: Tuple[int, int]
+    ) -> bool:
+        return self._key(key) in self._distances
+
+    def __getitem__(
+            self,
+            key: Tuple[int, int]
+    ) -> float:
+        key = self._key(key)
+        self._distances.move_to_end(key)
+        return self._distances[key]
+
+    def __setitem__(
+            self,
+            key: Tuple[int, int],
+            distance: float
+    ) -> None:
+        key = self._key(key)
+        self._distances[key] = distance
+        self._distances.move_to_end(key)
+
+        while len(self._distances) > self._max_entries:
+            self._distances.popitem(last=False)
+            self._evictions += 1
+
+    def clear(
+            self
+    ) -> None:
+        self._distances.clear()
+
+    def get_max_entries(
+            self
+    ) -> int:
+        return self._max_entries
+
+    def get_evictions(
+            self
+    ) -> int:
+        return self._evictions
+
+
+class DiskDistanceCache:
+    _filename: str
+    _n: int
+    _fingerprint: str
+
+    # ids whose whole row is on disk, and the rows mapped so far
+    _known: Set[int]
+    _rows: Dict[int, np.ndarray]
+
+    def __init__(
+            self,
+            filename: str,
+            n: int,
+            fingerprint: str
+    ) -> None:
+        self._filename = filename
+        self._n = n
+        self._fingerprint = fingerprint
+        self._rows = {}
+        self.reload()
+
+    @classmethod
+    def open(
+            cls,
+            dir_path: str,
+            store: GraphStore,
+            distance: Callable[[Graph, Graph], float]
+    ) -> "DiskDistanceCache":
+        # one directory per metric, reused by every fit on the same store whatever its threshold
+        metric: str = distance.__name__
+        filename: str = dir_path + "/" + metric
+        header = {"n": len(store), "metric": metric, "fingerprint": store.get_fingerprint(), "layout": "rows"}
+
+        existing = None
+        if os.path.exists(filename + ".json"):
+            with open(filename + ".json", "r") as file:
+                existing = json.load(file)
+
+        if existing != header or not os.path.isdir(filename):
+            # rows of another store are useless, and so are the condensed files of the previous layout
+            shutil.rmtree(filename, ignore_errors=True)
+            for suffix in (".npy", ".known.npy"):
+                if os.path.exists(filename + suffix):
+                    os.remove(filename + suffix)
+
+            os.makedirs(filename)
+            with open(filename + ".json", "w") as file:
+                json.dump(header, file)
+
+        return cls(filename, len(store), header["fingerprint"])
+
+    def __getstate__(
+            self
+    ) -> Dict:
+        # worker processes map the same files instead of receiving a copy of them
+        return {"filename": self._filename, "n": self._n, "fingerprint": self._fingerprint}
+
+    def __setstate__(
+            self,
+            state: Dict
+    ) -> None:
+        self.__init__(state["filename"], state["n"], state["fingerprint"])
+
+    def __len__(
+            self
+    ) -> int:
+        return self._n
+
+    def reload(
+            self
+    ) -> None:
+        # picks up the rows other processes added to the directory
+        self._known = {int(name[:-len(".npy")]) for name in os.listdir(self._filename) if name.endswith(".npy")}
+
+    def matches(
+            self,
+            store: GraphStore
+    ) -> bool:
+        return len(store) == self._n and store.get_fingerprint() == self._fingerprint
+
+    def _row(
+            self,
+            graph_id: int
+    ) -> np.ndarray:
+        if graph_id not in self._rows:
+            self._rows[graph_id] = np.load(f"{self._filename}/{graph_id}.npy", mmap_mode="r")
+        return self._rows[graph_id]
+
+    def has_rows(
+            self,
+            ids: np.ndarray
+    ) -> np.ndarray:
+        return np.array([int(i) in self._known for i in ids], dtype=np.bool_)
+
+    def __contains__(
+            self,
+            key: Tuple[int, int]
+    ) -> bool:
+        i, j = key
+        return i == j or i in self._known or j in self._known
+
+    def __getitem__(
+            self,
+            key: Tuple[int, int]
+    ) -> float:
+        i, j = key
+        if i == j:
+            return 0.0
+        return float(self._row(i)[j]) if i in self._known else float(self._row(j)[i])
+
+    def __setitem__(
+            self,
+            key: Tuple[int, int],
+            distance: float
+    ) -> None:
+        # single pairs are not kept, only whole rows are, see add_rows
+        pass
+
+    def lookup(
+            self,
+            rows: np.ndarray,
+            cols: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        distances = np.zeros((len(rows), len(cols)), dtype=np.float64)
+        known = rows[:, None] == cols[None, :]
+
+        for r in np.flatnonzero(self.has_rows(rows)):
+            distances[r] = self._row(int(rows[r]))[cols]
+            known[r] = True
+
+        # distances are symmetric, a computed column row also answers the pairs of unknown rows
+        pending: np.ndarray = np.flatnonzero(~known.all(axis=0))
+
+        for c in pending[self.has_rows(cols[pending])]:
+            unknown = ~known[:, c]
+            distances[unknown, c] = self._row(int(cols[c]))[rows[unknown]]
+            known[:, c] = True
+
+        return distances, known
+
+    def add_rows(
+            self,
+            ids: np.ndarray,
+            distances: np.ndarray
+    ) -> None:
+        # every row is written to a temporary file first, so workers never read a partial one
+        for graph_id, row in zip(ids, distances):
+            graph_id = int(graph_id)
+            filename: str = f"{self._filename}/{graph_id}.npy"
+
+            with open(filename + ".tmp", "wb") as file:
+                np.save(file, np.asarray(row, dtype=np.float64))
+            os.replace(filename + ".tmp", filename)
+
+            self._known.add(graph_id)
+
+
+def cached_cross_distances(
+        distance: Callable[[Graph, Graph], float],
+        vertexes: np.ndarray,
+        rows: np.ndarray,
+        cols: np.ndarray,
+        cache: Optional[DiskDistanceCache] = None
+) -> np.ndarray:
+    if cache is None:
+        return cross_distances(distance, vertexes[rows], vertexes[cols])
+
+    distances, known = cache.lookup(rows, cols)
+    missing = np.flatnonzero(~known.all(axis=1))
+
+    if len(missing) == 0:
+        return distances
+
+    # rows asked against the whole store are kept, rows against a subset are only computed
+    if len(cols) == len(cache):
+        computed = cross_distances(distance, vertexes[rows[missing]], vertexes)
+        cache.add_rows(rows[missing], computed)
+        distances[missing] = computed[:, cols]
+    else:
+        distances[missing] = cross_distances(distance, vertexes[rows[missing]], vertexes[cols])
+
+    return distances
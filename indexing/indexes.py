@@ -1,64 +1,266 @@
 from graph.essential import Graph, Cluster
-from typing import List, Callable, Tuple
+from graph.store import GraphStore, STORE_FILENAME, load_arrays
+from graph.pairwise import cross_distances, PAIR_BYTES, MEMORY_BUDGET
+from indexing.workers import WorkerPool, worker_vertexes, worker_distance
+from indexing.cache import DiskDistanceCache, cached_cross_distances
+from typing import List, Callable, Tuple, Union, Optional, Dict
+import numpy as np
+import os
 import pickle
 from random import sample
 
+# version 2 index files: centroid ids and CSR members pointing into a pose store saved next to them
+INDEX_VERSION: int = 2
+
+# stores already read from disk, so every index saved against the same file shares one copy
+_loaded_stores: Dict[Tuple[str, Optional[str]], GraphStore] = {}
+
+
+def load_shared_store(
+        filename: str,
+        mmap_mode: Optional[str] = None
+) -> GraphStore:
+    key = (os.path.abspath(filename), mmap_mode)
+    if key not in _loaded_stores:
+        _loaded_stores[key] = GraphStore.load(filename, mmap_mode)
+    return _loaded_stores[key]
+
+
+def cluster_members(
+        vertexes: np.ndarray,
+        graph_ids: np.ndarray,
+        centroid_ids: np.ndarray,
+        distance: Callable[[Graph, Graph], float],
+        threshold: float,
+        cache: Optional[DiskDistanceCache] = None
+) -> Tuple[List[np.ndarray], np.ndarray]:
+    members: List[np.ndarray] = []
+    radii: np.ndarray = np.zeros(len(centroid_ids), dtype=np.float64)
+
+    # centroids x graphs distances, one block of whole centroid rows at a time, so a disk cache keeps them
+    block: int = max(1, MEMORY_BUDGET // (PAIR_BYTES * max(len(graph_ids), 1)))
+
+    for b0 in range(0, len(centroid_ids), block):
+        distances = cached_cross_distances(distance, vertexes, centroid_ids[b0:b0 + block], graph_ids, cache)
+
+        for row, c in enumerate(range(b0, min(b0 + block, len(centroid_ids)))):
+            within = distances[row] < threshold
+            members.append(graph_ids[within])
+            radii[c] = distances[row][within].max(initial=0)
+
+    return members, radii
+
+
+def _worker_cluster_members(
+        args: Tuple[np.ndarray, np.ndarray, float, Optional[DiskDistanceCache]]
+) -> Tuple[List[np.ndarray], np.ndarray]:
+    graph_ids, centroid_ids, threshold, cache = args
+    return cluster_members(worker_vertexes(), graph_ids, centroid_ids, worker_distance(), threshold, cache)
+
 
 class HyperGraph:
-    _graphs: List[Graph]
+    _store: GraphStore
+    _graph_ids: np.ndarray
     _clusters: List[Cluster] = []
     _centroids: List[Graph]
     _distance: Callable[[Graph, Graph], float]
     _threshold: float
 
+    # distances kept on disk between fits, see DiskDistanceCache
+    _distance_cache: Optional[DiskDistanceCache] = None
+
+    # store ids of every centroid and of the members of each cluster (centroid first)
+    _centroid_ids: np.ndarray
+    _memberships: List[np.ndarray]
+
+    # largest member to centroid distance of each cluster
+    _radii: Optional[np.ndarray] = None
+
+    # set when the store comes from load_shared_store and is not owned by this index alone
+    _shared_store: bool = False
+
     # measurements
     _overlapping: float
     _density: float
 
     def __init__(
             self,
-            graphs,
+            graphs: Union[List[Graph], GraphStore],
             distance,
             threshold,
-            centroids
+            centroids,
+            distance_cache: Optional[DiskDistanceCache] = None
     ) -> None:
-        self._graphs = graphs
+        # graphs are always taken from the store, so their ids are its row indices
+        self._store = graphs if isinstance(graphs, GraphStore) else GraphStore.from_graphs(graphs)
+        self._graph_ids = np.arange(len(self._store))
+        self._clusters = []
         self._centroids = centroids
         self._distance = distance
         self._threshold = threshold
+        self._distance_cache = distance_cache
+        self._centroid_ids = np.empty(0, dtype=np.int64)
+        self._memberships = []
         self._overlapping = 0.0
         self._density = 0.0
 
+    def _index_graphs(
+            self,
+            graphs: List[Graph]
+    ) -> np.ndarray:
+        # graphs from elsewhere (e.g. centroids loaded on their own) are matched by path,
+        # the ones missing from the store are appended to it
+        missing = {graph.get_path(): graph for graph in graphs if self._store.get_id(graph.get_path()) < 0}
+
+        if len(missing) > 0:
+            self._store = GraphStore.concatenate([self._store, GraphStore.from_graphs(list(missing.values()))])
+
+        return np.array([self._store.get_id(graph.get_path()) for graph in graphs], dtype=np.int64)
+
     def fit(
-            self
+            self,
+            workers: Optional[int] = None
     ) -> None:
         self._clusters = []
-        self._overlapping = 0.0
+        self._centroid_ids = self._index_graphs(self._centroids)
+        self._centroids = self._store.get_graphs(self._centroid_ids)
 
-        for centroid in self._centroids:
-            cluster = Cluster()
-            cluster.set_centroid(centroid)
-            self._clusters.append(cluster)
+        graph_ids: np.ndarray = self._graph_ids
+        vertexes: np.ndarray = self._store.get_vertexes()
 
-        for cluster in self._clusters:
-            for graph in self._graphs:
-                if graph.get_path() == cluster.get_centroid().get_path():
-                    continue
-                if self._distance(graph, cluster.get_centroid()) < self._threshold:
-                    cluster.add_graph(graph)
-            self._overlapping += len(cluster.get_graphs())
+        # the cache is indexed by the store it was opened for, a store grown by new centroids can't use it
+        cache = self._distance_cache
+        if cache is not None and not cache.matches(self._store):
+            print("distance cache does not match the graphs, fitting without it")
+            cache = None
+
+        if workers is None:
+            members, self._radii = cluster_members(
+                vertexes, graph_ids, self._centroid_ids, self._distance, self._threshold, cache
+            )
+        else:
+            # centroids are split in order and the pieces concatenated back, so the result matches the serial fit
+            parts = np.array_split(self._centroid_ids, 4 * workers)
+
+            with WorkerPool(vertexes, self._distance, workers) as executor:
+                results = executor.map(
+                    _worker_cluster_members, [(graph_ids, part, self._threshold, cache) for part in parts]
+                )
 
-        n_clusters = len(self._clusters)
-        n_graphs = len(self._graphs)
+            members = [cluster for result, _ in results for cluster in result]
+            self._radii = np.concatenate([radii for _, radii in results])
+
+        self.set_members(members, self._radii)
+
+    def set_members(
+            self,
+            members: List[np.ndarray],
+            radii: np.ndarray
+    ) -> None:
+        # members[c] are the store ids within the threshold of centroid c, as cluster_members returns them
+        self._clusters = []
+        self._centroid_ids = self._index_graphs(self._centroids)
+        self._centroids = self._store.get_graphs(self._centroid_ids)
+        self._radii = radii
+        self._memberships = []
 
-        self._overlapping = self._overlapping / n_graphs
-        self._density = n_clusters / n_graphs
+        for centroid_id, cluster in zip(self._centroid_ids, members):
+            self._memberships.append(np.concatenate([[centroid_id], cluster[cluster != centroid_id]]).astype(np.int64))
+
+        self._overlapping = sum(len(membership) for membership in self._memberships) / len(self._graph_ids)
+        self._density = len(self._centroids) / len(self._graph_ids)
+
+    def _index_clusters(
+            self,
+            clusters: List[Cluster]
+    ) -> None:
+        self._centroids = [cluster.get_centroid() for cluster in clusters]
+
+        # grow the store once with everything it lacks before looking the clusters up
+        self._index_graphs(self._centroids + [graph for cluster in clusters for graph in cluster.get_graphs()])
+
+        self._centroid_ids = self._index_graphs(self._centroids)
+        self._centroids = self._store.get_graphs(self._centroid_ids)
+        self._memberships = [self._index_graphs(cluster.get_graphs()) for cluster in clusters]
+        self._radii = None
 
     def get_clusters(
             self
     ) -> List[Cluster]:
+        if len(self._clusters) == 0 and len(self._memberships) > 0:
+            for centroid, membership in zip(self._centroids, self._memberships):
+                cluster = Cluster()
+                cluster.set_centroid(centroid)
+
+                for graph in self._store.get_graphs(membership[1:]):
+                    cluster.add_graph(graph)
+
+                self._clusters.append(cluster)
+
         return self._clusters
 
+    def get_store(
+            self
+    ) -> GraphStore:
+        return self._store
+
+    def get_centroids(
+            self
+    ) -> List[Graph]:
+        return self._centroids
+
+    def get_centroid_ids(
+            self
+    ) -> np.ndarray:
+        return self._centroid_ids
+
+    def get_centroid_vertexes(
+            self
+    ) -> np.ndarray:
+        return self._store.get_vertexes()[self._centroid_ids]
+
+    def get_memberships(
+            self
+    ) -> List[np.ndarray]:
+        return self._memberships
+
+    def get_radii(
+            self
+    ) -> np.ndarray:
+        # indexes loaded from older files carry no radii, they are measured on first use
+        if self._radii is None:
+            vertexes: np.ndarray = self._store.get_vertexes()
+            self._radii = np.array([
+                cross_distances(self._distance, vertexes[membership[:1]], vertexes[membership])[0].max()
+                for membership in self._memberships
+            ], dtype=np.float64)
+
+        return self._radii
+
+    def get_cluster_sizes(
+            self
+    ) -> np.ndarray:
+        return np.array([len(membership) for membership in self._memberships], dtype=np.int64)
+
+    def get_nbytes(
+            self
+    ) -> int:
+        # memory held by this index alone, memory-mapped arrays included since they fill the page cache
+        # as they are read; a shared store is left to the caller, it is paid for once for all indexes
+        arrays = [self._centroid_ids, *self._memberships]
+
+        if self._radii is not None:
+            arrays.append(self._radii)
+        if not self._shared_store:
+            arrays.append(self._store.get_vertexes())
+
+        return sum(array.nbytes for array in arrays)
+
+    def has_shared_store(
+            self
+    ) -> bool:
+        return self._shared_store
+
     def get_overlapping(
             self
     ) -> float:
@@ -82,23 +284,92 @@ class HyperGraph:
     def save_clusters(
             self,
             dir_path,
-            filename
+            filename,
+            store_filename: str = STORE_FILENAME
     ) -> None:
-        with open(dir_path + "/" + filename, "wb") as file:
-            data: Tuple[List[Cluster], float, float] = (self._clusters, self._overlapping, self._density)
-            pickle.dump(data, file)
+        if not filename.endswith(".npz"):
+            with open(dir_path + "/" + filename, "wb") as file:
+                data: Tuple[List[Cluster], float, float] = (self.get_clusters(), self._overlapping, self._density)
+                pickle.dump(data, file)
+            return
+
+        # the store is written once and shared by every index saved against it
+        store_path: str = dir_path + "/" + store_filename
+        fingerprint: str = self._store.get_fingerprint()
+
+        if not os.path.exists(store_path):
+            self._store.save(store_path)
+        elif load_shared_store(store_path).get_fingerprint() != fingerprint:
+            raise ValueError(f"{store_path} holds different graphs than this index")
+
+        sizes = [len(membership) for membership in self._memberships]
+        np.savez(
+            dir_path + "/" + filename,
+            version=np.array(INDEX_VERSION),
+            store=np.array(store_filename),
+            fingerprint=np.array(fingerprint),
+            threshold=np.array(self._threshold, dtype=np.float64),
+            centroid_ids=self._centroid_ids.astype(np.int32),
+            offsets=np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64),
+            members=np.concatenate(self._memberships).astype(np.int32) if sizes else np.empty(0, np.int32),
+            radii=self.get_radii(),
+            overlapping=np.array(self._overlapping),
+            density=np.array(self._density)
+        )
 
     def load_clusters(
             self,
             dir_path,
-            filename
+            filename,
+            mmap_mode: Optional[str] = None
     ) -> None:
+        if filename.endswith(".npz"):
+            self._load_index(dir_path, filename, mmap_mode)
+            return
+
+        if mmap_mode is not None:
+            raise ValueError(f"Only version 2 (.npz) indexes can be memory-mapped, got {filename}")
+
         with open(dir_path + "/" + filename, "rb") as file:
             data: Tuple[List[Cluster], float, float] = pickle.load(file)
-            self._clusters = data[0]
             self._overlapping = data[1]
             self._density = data[2]
 
+        # the pickled clusters are dropped once indexed, get_clusters rebuilds them from the store
+        self._index_clusters(data[0])
+        self._clusters = []
+
+    def _load_index(
+            self,
+            dir_path,
+            filename,
+            mmap_mode: Optional[str] = None
+    ) -> None:
+        data = load_arrays(dir_path + "/" + filename, mmap_mode)
+
+        if int(data["version"]) != INDEX_VERSION:
+            raise ValueError(f"Unsupported index version {int(data['version'])} in {filename}")
+
+        store = load_shared_store(dir_path + "/" + str(data["store"]), mmap_mode)
+        if store.get_fingerprint() != str(data["fingerprint"]):
+            raise ValueError(f"{filename} was saved against different graphs than {data['store']}")
+
+        # with a mmap mode the memberships are views into the mapped member array
+        offsets: np.ndarray = np.asarray(data["offsets"])
+        members: np.ndarray = data["members"]
+
+        self._store = store
+        self._shared_store = True
+        self._graph_ids = np.arange(len(store))
+        self._centroid_ids = data["centroid_ids"]
+        self._memberships = [members[offsets[c]:offsets[c + 1]] for c in range(len(offsets) - 1)]
+        self._radii = data["radii"]
+        self._overlapping = float(data["overlapping"])
+        self._density = float(data["density"])
+
+        self._centroids = store.get_graphs(self._centroid_ids)
+        self._clusters = []
+
     def pretty_print(
             self,
             k: int = 10
@@ -113,4 +384,24 @@ class HyperGraph:
         print("measurements:")
         print(f"\toverlapping: {self.get_overlapping()}")
         print(f"\tdensity: {self.get_density()}")
-        print(f"\tnumber of clusters: {len(self._clusters)}")
+        print(f"\tnumber of clusters: {len(self._memberships)}")
+
+
+def convert_clusters(
+        dir_path: str,
+        filename: str,
+        store: GraphStore,
+        distance: Callable[[Graph, Graph], float],
+        threshold: float,
+        store_filename: str = STORE_FILENAME
+) -> str:
+    # rewrites a pickled Cluster index as a version 2 file next to it, against the shared store
+    hyper_graph = HyperGraph(store, distance, threshold, [])
+    hyper_graph.load_clusters(dir_path, filename)
+
+    if len(hyper_graph.get_store()) != len(store):
+        raise ValueError(f"{filename} has graphs that are not in the store")
+
+    converted: str = os.path.splitext(filename)[0] + ".npz"
+    hyper_graph.save_clusters(dir_path, converted, store_filename)
+    return converted
@@ -0,0 +1,174 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from graph.essential import Graph
+from indexing.indexes import HyperGraph
+
+# distance, threshold, directory, filename and mmap mode of a registered index
+IndexSpec = Tuple[Callable[[Graph, Graph], float], float, str, str, Optional[str]]
+
+
+class IndexRegistry:
+    _specs: Dict[str, IndexSpec]
+    _loaded: "OrderedDict[str, HyperGraph]"
+    _memory_budget: Optional[int]
+
+    # measured size of every index opened so far, used to plan the background loads
+    _nbytes: Dict[str, int]
+
+    # one lock per index so a query waits for the background load of that index only
+    _locks: Dict[str, threading.Lock]
+    _lock: threading.Lock
+    _thread: Optional[threading.Thread] = None
+
+    def __init__(
+            self,
+            memory_budget: Optional[int] = None
+    ) -> None:
+        self._specs = {}
+        self._loaded = OrderedDict()
+        self._memory_budget = memory_budget
+        self._nbytes = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(
+            self,
+            name: str,
+            distance: Callable[[Graph, Graph], float],
+            threshold: float,
+            dir_path: str,
+            filename: str,
+            mmap_mode: Optional[str] = None
+    ) -> None:
+        self._specs[name] = (distance, threshold, dir_path, filename, mmap_mode)
+        self._locks[name] = threading.Lock()
+
+    def get_names(
+            self
+    ) -> List[str]:
+        return list(self._specs)
+
+    def is_loaded(
+            self,
+            name: str
+    ) -> bool:
+        return name in self._loaded
+
+    def get(
+            self,
+            name: str
+    ) -> HyperGraph:
+        return self._get(name, evict=True)
+
+    def _get(
+            self,
+            name: str,
+            evict: bool
+    ) -> HyperGraph:
+        with self._locks[name]:
+            with self._lock:
+                if name in self._loaded:
+                    self._loaded.move_to_end(name)
+                    return self._loaded[name]
+
+            hyper_graph = self._open(name)
+
+            with self._lock:
+                self._loaded[name] = hyper_graph
+                self._nbytes[name] = hyper_graph.get_nbytes()
+                if evict:
+                    self._evict()
+
+            return hyper_graph
+
+    def _open(
+            self,
+            name: str
+    ) -> HyperGraph:
+        distance, threshold, dir_path, filename, mmap_mode = self._specs[name]
+        path, mode = self._resolve(name)
+        start = time.time()
+
+        if path != filename:
+            print(f"{filename} not found, loading {path} instead: run convert_hypergraphs.py to map it")
+
+        hyper_graph = HyperGraph(distance=distance, threshold=threshold, centroids=[], graphs=[])
+        hyper_graph.load_clusters(dir_path, path, mode)
+
+        print(f"loaded {name} in {time.time() - start:.2f} s ({hyper_graph.get_nbytes() / 2 ** 20:.1f} MB)")
+        return hyper_graph
+
+    def _resolve(
+            self,
+            name: str
+    ) -> Tuple[str, Optional[str]]:
+        # a fresh checkout only has the pickled indexes until convert_hypergraphs.py runs,
+        # those are loaded whole instead of mapped
+        _, _, dir_path, filename, mmap_mode = self._specs[name]
+        legacy: str = os.path.splitext(filename)[0] + ".p"
+
+        if filename.endswith(".npz") and not os.path.exists(dir_path + "/" + filename) \
+                and os.path.exists(dir_path + "/" + legacy):
+            return legacy, None
+        return filename, mmap_mode
+
+    @staticmethod
+    def _total_nbytes(
+            hyper_graphs: List[HyperGraph]
+    ) -> int:
+        # a shared store is counted once, whatever the number of indexes using it
+        stores = {id(hyper_graph.get_store()): hyper_graph.get_store() for hyper_graph in hyper_graphs if hyper_graph.has_shared_store()}
+        return sum(hyper_graph.get_nbytes() for hyper_graph in hyper_graphs) + sum(store.get_vertexes().nbytes for store in stores.values())
+
+    def get_nbytes(
+            self
+    ) -> int:
+        with self._lock:
+            return self._total_nbytes(list(self._loaded.values()))
+
+    def _expected_nbytes(
+            self,
+            name: str
+    ) -> int:
+        if name in self._nbytes:
+            return self._nbytes[name]
+
+        # arrays are stored uncompressed, mapped or not an index takes about its size on disk
+        _, _, dir_path, _, _ = self._specs[name]
+        return os.path.getsize(dir_path + "/" + self._resolve(name)[0])
+
+    def _evict(
+            self
+    ) -> None:
+        # least recently used first, the most recently used index always stays
+        if self._memory_budget is None:
+            return
+
+        for name in list(self._loaded)[:-1]:
+            if self._total_nbytes(list(self._loaded.values())) <= self._memory_budget:
+                break
+
+            del self._loaded[name]
+            print(f"evicted {name}")
+
+    def preload(
+            self,
+            names: Optional[List[str]] = None
+    ) -> None:
+        # opens the indexes in a background thread, stopping before the first one that would not fit
+        # in the memory budget: preloading never evicts what a query already opened
+        def load() -> None:
+            for name in names or self.get_names():
+                if self.is_loaded(name):
+                    continue
+                if self._memory_budget is not None and self.get_nbytes() + self._expected_nbytes(name) > self._memory_budget:
+                    break
+                self._get(name, evict=False)
+
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=load, daemon=True)
+            self._thread.start()
@@ -0,0 +1,81 @@
+import numpy as np
+
+from typing import Callable, Dict, List, Optional, Tuple
+from graph.essential import Graph
+from graph.store import GraphStore
+from indexing.indexes import HyperGraph
+from indexing.cache import DiskDistanceCache, cached_cross_distances
+
+
+def leader_rows(
+        store: GraphStore,
+        distance: Callable[[Graph, Graph], float],
+        threshold: float,
+        distance_cache: Optional[DiskDistanceCache] = None,
+        computed_rows: Optional[Dict[int, np.ndarray]] = None
+) -> Tuple[np.ndarray, List[np.ndarray], np.ndarray]:
+    # the leader algorithm one whole leader row at a time: the row assigns every later graph at once
+    # and gives the cluster members, and through the cache it is shared by every threshold
+    n: int = len(store)
+    graph_ids: np.ndarray = np.arange(n)
+    vertexes: np.ndarray = store.get_vertexes()
+
+    # same visiting order as MeanShift's leader fit: the first graph, then the rest backwards
+    order: np.ndarray = np.concatenate([np.arange(min(n, 1)), np.arange(n - 1, 0, -1)])
+
+    unassigned: np.ndarray = np.ones(n, dtype=np.bool_)
+    leader_ids: List[int] = []
+    members: List[np.ndarray] = []
+    radii: List[float] = []
+
+    position: int = 0
+
+    while position < n:
+        leader: int = int(order[position])
+        if computed_rows is not None and leader in computed_rows:
+            row = computed_rows[leader]
+        else:
+            row = cached_cross_distances(distance, vertexes, np.array([leader]), graph_ids, distance_cache)[0]
+            if computed_rows is not None:
+                computed_rows[leader] = row
+
+        unassigned &= row > threshold
+        unassigned[leader] = False
+
+        within = row < threshold
+        leader_ids.append(leader)
+        members.append(graph_ids[within])
+        radii.append(row[within].max(initial=0))
+
+        # every graph visited before this leader is assigned already
+        remaining = np.flatnonzero(unassigned[order[position:]])
+        position = position + int(remaining[0]) if len(remaining) > 0 else n
+
+    return np.array(leader_ids, dtype=np.int64), members, np.array(radii, dtype=np.float64)
+
+
+def sweep_thresholds(
+        store: GraphStore,
+        distance: Callable[[Graph, Graph], float],
+        thresholds: List[float],
+        distance_cache: Optional[DiskDistanceCache] = None
+) -> List[HyperGraph]:
+    hyper_graphs: List[HyperGraph] = []
+
+    # without a disk cache the leader rows are kept in memory for the whole sweep, most leaders
+    # of one threshold are leaders of the next as well
+    computed_rows: Optional[Dict[int, np.ndarray]] = {} if distance_cache is None else None
+
+    for threshold in thresholds:
+        leader_ids, members, radii = leader_rows(store, distance, threshold, distance_cache, computed_rows)
+
+        hyper_graph = HyperGraph(store, distance, threshold, store.get_graphs(leader_ids))
+        hyper_graph.set_members(members, radii)
+        hyper_graphs.append(hyper_graph)
+
+        sizes: np.ndarray = hyper_graph.get_cluster_sizes()
+        print(f"threshold {threshold}: {len(sizes)} clusters, "
+              f"overlapping {hyper_graph.get_overlapping():.3f}, density {hyper_graph.get_density():.4f}, "
+              f"cluster size min {sizes.min()} / median {int(np.median(sizes))} / mean {sizes.mean():.1f} / max {sizes.max()}")
+
+    return hyper_graphs
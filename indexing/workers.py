@@ -0,0 +1,90 @@
+from multiprocess import pool
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import os
+
+from typing import Callable, Dict, Tuple, List, Any, Optional
+from graph.essential import Graph
+from graph.store import share_vertexes, attach_vertexes
+
+# state of a worker process, filled once by _init_worker
+_state: Dict = {}
+
+
+def _init_worker(
+        name: str,
+        shape: Tuple[int, ...],
+        dtype: str,
+        distance_function: Callable[[Graph, Graph], float]
+) -> None:
+    _state["shared"], _state["vertexes"] = attach_vertexes(name, shape, dtype)
+    _state["distance"] = distance_function
+
+
+def worker_vertexes(
+) -> np.ndarray:
+    return _state["vertexes"]
+
+
+def worker_distance(
+) -> Callable[[Graph, Graph], float]:
+    return _state["distance"]
+
+
+class WorkerPool:
+    _pool: Optional[pool.Pool]
+    _shared: Optional[SharedMemory]
+    _workers: int
+
+    def __init__(
+            self,
+            vertexes: np.ndarray,
+            distance_function: Callable[[Graph, Graph], float],
+            workers: Optional[int] = None
+    ) -> None:
+        self._workers = workers or os.cpu_count() or 1
+
+        # the pose block is shipped once through shared memory instead of with every task
+        self._shared = share_vertexes(vertexes)
+        self._pool = pool.Pool(
+            processes=self._workers,
+            initializer=_init_worker,
+            initargs=(self._shared.name, vertexes.shape, vertexes.dtype.str, distance_function)
+        )
+
+    def __enter__(
+            self
+    ) -> "WorkerPool":
+        return self
+
+    def __exit__(
+            self,
+            *args
+    ) -> None:
+        self.close()
+
+    @property
+    def workers(
+            self
+    ) -> int:
+        return self._workers
+
+    def map(
+            self,
+            function: Callable[[Any], Any],
+            tasks: List[Any]
+    ) -> List[Any]:
+        return self._pool.map(function, tasks)
+
+    def close(
+            self
+    ) -> None:
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+        if self._shared is not None:
+            self._shared.close()
+            self._shared.unlink()
+            self._shared = None
@@ -7,14 +7,16 @@ import math
 from graph.essential import Graph
 from graph.embeddings.full_body_3D import get_graph_from_full_body_image, get_pose_model
 
-from indexing.indexes import HyperGraph
+from indexing.registry import IndexRegistry
 from retrieval.algorithms import knn_retrieval
 from dataset.pickle import load_activity_per_image
 
 
 class GUI:
-    _hyper_graphs: List[HyperGraph]
-    _pose_model = get_pose_model()
+    _indexes: IndexRegistry
+
+    # built on the first query, not when the module is imported
+    _pose_model = None
 
     _query_path: str = ""
     _labels: List[str]
@@ -23,11 +25,16 @@ class GUI:
     _width = 1080
     _height = 1080
 
-    def __init__(self, hyper_graphs: List[HyperGraph], labels: List[str]):
-        self._hyper_graphs = hyper_graphs
-        self._labels = labels
+    def __init__(self, indexes: IndexRegistry):
+        self._indexes = indexes
+        self._labels = indexes.get_names()
         self._tags = load_activity_per_image()
 
+    def _get_pose_model(self):
+        if self._pose_model is None:
+            self._pose_model = get_pose_model()
+        return self._pose_model
+
     def run(self):
         margin_left = margin_top = 5
         query_width = math.floor(0.25*self._width)
@@ -65,13 +72,13 @@ class GUI:
             k = 6
             graph_query: Graph = get_graph_from_full_body_image(
                 path=self._query_path,
-                pose_model=self._pose_model,
+                pose_model=self._get_pose_model(),
                 threshold=0.0
             )
 
             result_paths: List[List[str]] = []
-            for hyper_graph in self._hyper_graphs:
-                result_paths.append(knn_retrieval(hyper_graph, graph_query, k=k))
+            for name in self._labels:
+                result_paths.append(knn_retrieval(self._indexes.get(name), graph_query, k=k))
 
             [print(x) for x in result_paths]
             for result in result_paths:
@@ -140,5 +147,8 @@ class GUI:
         for i, btn in enumerate(btns):
             btn.place(x=margin_left+10, y=(self._height/3) + i*50)
 
+        # Open the indexes in the background once the window is up
+        window.after(0, self._indexes.preload)
+
         # Let the window wait for any events
         window.mainloop()
@@ -1,49 +1,25 @@
 from interface.gui import GUI
 from graph.distances import weighted_distance, cosine_score, manhattan_distance, euclidean_distance, best_of_the_best_distance, cosine_v_distance, l2__distance
-from indexing.indexes import HyperGraph
+from indexing.registry import IndexRegistry
 
 T = 6
 
-weighted_hyper_graph = HyperGraph(distance=weighted_distance, threshold=T, centroids=[], graphs=[])
-weighted_hyper_graph.load_clusters("pickles/hyper_graphs", "weighted_6.p")
+# indexes are opened on first use or in the background once the window is shown,
+# least recently used ones are dropped past the budget
+indexes = IndexRegistry(memory_budget=512 * 1024 * 1024)
 
-cosine_hyper_graph = HyperGraph(distance=cosine_score, threshold=T, centroids=[], graphs=[])
-cosine_hyper_graph.load_clusters("pickles/hyper_graphs", "cosine_6.p")
+# version 2 indexes written by convert_hypergraphs.py, memory-mapped over one shared graphs.npz;
+# until they are converted the registry loads the pickled .p index next to each of them
+MMAP_MODE = "r"
 
-manhattan_hyper_graph = HyperGraph(distance=manhattan_distance, threshold=T, centroids=[], graphs=[])
-manhattan_hyper_graph.load_clusters("pickles/hyper_graphs", "manhattan_6.p")
+indexes.register("weighted distance", weighted_distance, T, "pickles/hyper_graphs", "weighted_6.npz", MMAP_MODE)
+indexes.register("cosine score", cosine_score, T, "pickles/hyper_graphs", "cosine_6.npz", MMAP_MODE)
+indexes.register("manhattan distance", manhattan_distance, T, "pickles/hyper_graphs", "manhattan_6.npz", MMAP_MODE)
+indexes.register("euclidean distance", euclidean_distance, T, "pickles/hyper_graphs", "euclidean_6.npz", MMAP_MODE)
+indexes.register("body distance", best_of_the_best_distance, 10, "pickles/hyper_graphs", "best_distance_1.5.npz", MMAP_MODE)
+indexes.register("cosine v distance", cosine_v_distance, 0.055, "pickles/hyper_graphs", "cosine_v_0_3.npz", MMAP_MODE)
+indexes.register("l2 v distance", l2__distance, 1.5, "pickles/hyper_graphs", "l2_6.npz", MMAP_MODE)
 
-euclidean_hyper_graph = HyperGraph(distance=euclidean_distance, threshold=T, centroids=[], graphs=[])
-euclidean_hyper_graph.load_clusters("pickles/hyper_graphs", "euclidean_6.p")
-
-l2_hyper_graph = HyperGraph(distance=l2__distance, threshold=1.5, centroids=[], graphs=[])
-l2_hyper_graph.load_clusters("pickles/hyper_graphs", "l2_6.p")
-
-cosine_v_hyper_graph = HyperGraph(distance=cosine_v_distance, threshold=0.055, centroids=[], graphs=[])
-cosine_v_hyper_graph.load_clusters("pickles/hyper_graphs", "cosine_v_0_3.p")
-
-best_hyper_graph = HyperGraph(distance=best_of_the_best_distance, threshold=10, centroids=[], graphs=[])
-best_hyper_graph.load_clusters("pickles/hyper_graphs", "best_distance_1.5.p")
-
-user_interface = GUI(
-    [
-        weighted_hyper_graph,
-        cosine_hyper_graph,
-        manhattan_hyper_graph,
-        euclidean_hyper_graph,
-        best_hyper_graph,
-        cosine_v_hyper_graph,
-        l2_hyper_graph
-    ],
-    [
-        "weighted distance",
-        "cosine score",
-        "manhattan distance",
-        "euclidean distance",
-        "body distance",
-        "cosine v distance",
-        "l2 v distance"
-    ]
-)
+user_interface = GUI(indexes)
 
 user_interface.run()
@@ -1,7 +1,13 @@
 import timeit
 
-from typing import List, Callable
-from graph.essential import Graph, Cluster
+import numpy as np
+
+from typing import List, Callable, Tuple, Union, Iterator
+from graph.essential import Graph
+from graph.store import GraphStore
+from graph.distances import is_metric
+from graph.pairwise import cross_distances, MEMORY_BUDGET
+from graph.store import stack_vertexes
 from indexing.indexes import HyperGraph
 
 
@@ -17,11 +23,27 @@ def measure_execution_time(func):
     return wrapper
 
 
+def top_k(
+        distances: np.ndarray,
+        k: int
+) -> np.ndarray:
+    # positions of the k smallest distances in ascending order, without sorting the rest
+    if k < len(distances):
+        nearest = np.argpartition(distances, k - 1)[:k]
+    else:
+        nearest = np.arange(len(distances))
+
+    return nearest[np.lexsort((nearest, distances[nearest]))]
+
+
 class KNN:
     _hypergraph: HyperGraph
     _distance_fn: Callable[[Graph, Graph], float]
     _threshold: float
 
+    # distance evaluations performed by the last query
+    _evaluations: int
+
     def __init__(
             self,
             hypergraph: HyperGraph,
@@ -29,21 +51,222 @@ class KNN:
         self._hypergraph = hypergraph
         self._distance_fn = hypergraph.get_distance()
         self._threshold = hypergraph.get_threshold()
+        self._evaluations = 0
+
+    def get_evaluations(
+            self
+    ) -> int:
+        return self._evaluations
+
+    def _candidates(
+            self,
+            centroid_distances: np.ndarray,
+            n_probe: int
+    ) -> np.ndarray:
+        if n_probe < 1:
+            raise ValueError(f"n_probe must be at least 1, got {n_probe}")
+
+        memberships: List[np.ndarray] = self._hypergraph.get_memberships()
+        probes = centroid_distances.argsort(kind="stable")[:n_probe]
+
+        if len(probes) == 1:
+            return memberships[probes[0]]
+
+        # overlapping clusters share members, keep the first occurrence of each
+        candidates = np.concatenate([memberships[c] for c in probes])
+        _, first = np.unique(candidates, return_index=True)
+        return candidates[np.sort(first)]
+
+    def query_with_distances(
+            self,
+            query: Graph,
+            k: int,
+            n_probe: int = 1
+    ) -> List[Tuple[str, float]]:
+        if k == 0:
+            return []
+
+        store: GraphStore = self._hypergraph.get_store()
+        vertexes: np.ndarray = store.get_vertexes()
+        query_vertexes = np.asarray(query.get_vertexes(), dtype=np.float64)[None]
+
+        centroid_distances = cross_distances(self._distance_fn, query_vertexes, self._hypergraph.get_centroid_vertexes())[0]
+        members: np.ndarray = self._candidates(centroid_distances, n_probe)
+
+        distances = cross_distances(self._distance_fn, query_vertexes, vertexes[members])[0]
+
+        self._evaluations = len(centroid_distances) + len(members)
+        return [(store.get_path(members[i]), float(distances[i])) for i in top_k(distances, k)]
+
+    def query_exact(
+            self,
+            query: Graph,
+            k: int
+    ) -> List[Tuple[str, float]]:
+        if not is_metric(self._distance_fn):
+            raise ValueError(f"{self._distance_fn.__name__} does not satisfy the triangle inequality")
 
-    def query(self, query: Graph, k: int) -> List[str]:
         if k == 0:
             return []
 
-        cluster: Cluster = min(self._hypergraph.get_clusters(),
-                               key=lambda c: self._distance_fn(c.get_centroid(), query))
+        store: GraphStore = self._hypergraph.get_store()
+        vertexes: np.ndarray = store.get_vertexes()
+        memberships: List[np.ndarray] = self._hypergraph.get_memberships()
+        radii: np.ndarray = self._hypergraph.get_radii()
+        query_vertexes = np.asarray(query.get_vertexes(), dtype=np.float64)[None]
+
+        centroid_distances = cross_distances(self._distance_fn, query_vertexes, self._hypergraph.get_centroid_vertexes())[0]
+        self._evaluations = len(centroid_distances)
+
+        best_ids: np.ndarray = np.empty(0, dtype=np.int64)
+        best_distances: np.ndarray = np.empty(0, dtype=np.float64)
+        seen: np.ndarray = np.zeros(len(store), dtype=bool)
+
+        # every member of c is at least d(q, c) - radius(c) away from the query, so a cluster whose
+        # bound is beyond the current k-th best cannot improve the answer; exact over all indexed poses
+        for c in centroid_distances.argsort(kind="stable"):
+            if len(best_ids) == k and centroid_distances[c] - radii[c] > best_distances[-1]:
+                continue
+
+            members = memberships[c][~seen[memberships[c]]]
+            if len(members) == 0:
+                continue
+
+            seen[members] = True
+            distances = cross_distances(self._distance_fn, query_vertexes, vertexes[members])[0]
+            self._evaluations += len(members)
+
+            best_ids = np.concatenate([best_ids, members])
+            best_distances = np.concatenate([best_distances, distances])
+
+            nearest = top_k(best_distances, k)
+            best_ids, best_distances = best_ids[nearest], best_distances[nearest]
 
-        sorted_paths = sorted(cluster.get_graphs(), key=lambda g: self._distance_fn(g, query))
-        n = min(k, len(sorted_paths))
+        return [(store.get_path(graph_id), float(distance)) for graph_id, distance in zip(best_ids, best_distances)]
 
-        return [graph.get_path() for graph in sorted_paths[:n]]
+    def range_query(
+            self,
+            query: Graph,
+            radius: float
+    ) -> Iterator[Tuple[str, float]]:
+        store: GraphStore = self._hypergraph.get_store()
+        vertexes: np.ndarray = store.get_vertexes()
+        memberships: List[np.ndarray] = self._hypergraph.get_memberships()
+        query_vertexes = np.asarray(query.get_vertexes(), dtype=np.float64)[None]
+
+        centroid_distances = cross_distances(self._distance_fn, query_vertexes, self._hypergraph.get_centroid_vertexes())[0]
+        self._evaluations = len(centroid_distances)
+
+        # the cluster bound only holds for metric distances, any other distance scans every cluster
+        pruned: bool = is_metric(self._distance_fn)
+        radii: np.ndarray = self._hypergraph.get_radii() if pruned else np.zeros(0)
+        seen: np.ndarray = np.zeros(len(store), dtype=bool)
+
+        for c in centroid_distances.argsort(kind="stable"):
+            if pruned and centroid_distances[c] - radii[c] > radius:
+                continue
+
+            members = memberships[c][~seen[memberships[c]]]
+            if len(members) == 0:
+                continue
+
+            seen[members] = True
+            distances = cross_distances(self._distance_fn, query_vertexes, vertexes[members])[0]
+            self._evaluations += len(members)
+
+            for i in np.flatnonzero(distances <= radius):
+                yield store.get_path(members[i]), float(distances[i])
+
+    def query(
+            self,
+            query: Graph,
+            k: int,
+            n_probe: int = 1
+    ) -> List[str]:
+        return [path for path, _ in self.query_with_distances(query, k, n_probe)]
+
+    def query_batch_with_distances(
+            self,
+            queries: Union[List[Graph], np.ndarray],
+            k: int,
+            n_probe: int = 1
+    ) -> List[List[Tuple[str, float]]]:
+        if n_probe < 1:
+            raise ValueError(f"n_probe must be at least 1, got {n_probe}")
+
+        if isinstance(queries, list):
+            queries = stack_vertexes(queries, dtype=np.float64)
+
+        n_queries: int = len(queries)
+        results: List[List[Tuple[str, float]]] = [[] for _ in range(n_queries)]
+        self._evaluations = 0
+
+        if k == 0 or n_queries == 0:
+            return results
+
+        store: GraphStore = self._hypergraph.get_store()
+        vertexes: np.ndarray = store.get_vertexes()
+        memberships: List[np.ndarray] = self._hypergraph.get_memberships()
+        centroid_vertexes: np.ndarray = self._hypergraph.get_centroid_vertexes()
+
+        # queries are taken in blocks so the Q x C centroid distances stay within the memory budget
+        block: int = max(1, MEMORY_BUDGET // (8 * max(len(centroid_vertexes), 1)))
+
+        for q0 in range(0, n_queries, block):
+            block_queries = queries[q0:q0 + block]
+            centroid_distances = cross_distances(self._distance_fn, block_queries, centroid_vertexes)
+            probes = centroid_distances.argsort(axis=1, kind="stable")[:, :n_probe]
+            self._evaluations += centroid_distances.size
+
+            n_probes: int = probes.shape[1]
+            candidate_ids: List[List[np.ndarray]] = [[None] * n_probes for _ in range(len(block_queries))]
+            candidate_distances: List[List[np.ndarray]] = [[None] * n_probes for _ in range(len(block_queries))]
+
+            # every probed cluster is scored against all the queries that selected it at once
+            pair_queries = np.repeat(np.arange(len(block_queries)), n_probes)
+            pair_ranks = np.tile(np.arange(n_probes), len(block_queries))
+            pair_clusters = probes.ravel()
+            order = pair_clusters.argsort(kind="stable")
+            clusters, starts = np.unique(pair_clusters[order], return_index=True)
+
+            for c, group, ranks in zip(clusters, np.split(pair_queries[order], starts[1:]), np.split(pair_ranks[order], starts[1:])):
+                members = memberships[c]
+                distances = cross_distances(self._distance_fn, block_queries[group], vertexes[members])
+                self._evaluations += distances.size
+
+                # kept in membership order and slotted by probe rank, so the merged list is a
+                # subsequence of the single query's candidates and ties break the same way
+                for row, (q, rank) in enumerate(zip(group, ranks)):
+                    nearest = np.sort(top_k(distances[row], k))
+                    candidate_ids[q][rank] = members[nearest]
+                    candidate_distances[q][rank] = distances[row, nearest]
+
+            for q in range(len(block_queries)):
+                ids = np.concatenate(candidate_ids[q])
+                distances = np.concatenate(candidate_distances[q])
+
+                # overlapping probes can return the same pose twice
+                _, first = np.unique(ids, return_index=True)
+                first.sort()
+                ids, distances = ids[first], distances[first]
+
+                nearest = top_k(distances, k)
+                results[q0 + q] = [(store.get_path(ids[i]), float(distances[i])) for i in nearest]
+
+        return results
+
+    def query_batch(
+            self,
+            queries: Union[List[Graph], np.ndarray],
+            k: int,
+            n_probe: int = 1
+    ) -> List[List[str]]:
+        return [[path for path, _ in result] for result in self.query_batch_with_distances(queries, k, n_probe)]
 
 
 @measure_execution_time
-def knn_retrieval(hyper_graph: HyperGraph, query: Graph, k: int):
+def knn_retrieval(hyper_graph: HyperGraph, query: Graph, k: int, n_probe: int = 1):
     knn = KNN(hyper_graph)
-    return knn.query(query, k)
+    result = knn.query(query, k, n_probe)
+    print(f"Distance evaluations: {knn.get_evaluations()}")
+    return result
@@ -0,0 +1,36 @@
+from dataset.pickle import load_graph_store, dump_centroids
+
+from graph.store import GraphStore
+from graph.distances import weighted_distance, euclidean_distance, manhattan_distance, cosine_score, best_of_the_best_distance
+
+from indexing.cache import DiskDistanceCache
+from indexing.sweep import sweep_thresholds
+
+graphs: GraphStore = load_graph_store("pickles/graphs")
+
+
+def build_sweep(distance_fn, name, thresholds):
+    cache = DiskDistanceCache.open("pickles/distance_cache", graphs, distance_fn)
+
+    print("------------------------- start -------------------------")
+    for hyper_graph in sweep_thresholds(graphs, distance_fn, thresholds, distance_cache=cache):
+        filename = f"{name}_{hyper_graph.get_threshold():g}.p"
+        dump_centroids(hyper_graph.get_centroids(), "pickles/centroids/" + filename)
+        hyper_graph.save_clusters("pickles/hyper_graphs", filename)
+    print("-------------------------- end --------------------------")
+
+
+# print("------------- euclidean distance -------------")
+# build_sweep(euclidean_distance, "euclidean", [5, 6, 7])
+#
+# print("--------------- cosine distance --------------")
+# build_sweep(cosine_score, "cosine", [5, 6, 7])
+#
+# print("------------- manhattan distance -------------")
+# build_sweep(manhattan_distance, "manhattan", [6, 7])
+#
+# print("-------------- weighted distance -------------")
+# build_sweep(weighted_distance, "weighted", [6, 7])
+
+print("-------------- best distance -------------")
+build_sweep(best_of_the_best_distance, "best_distance", [1.5, 6])